@@ -1,21 +1,236 @@
-import json
+import io
 import os
+import mmap
+import hashlib
+import orjson
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 import time
+import threading
 from requests.exceptions import ChunkedEncodingError, ConnectionError, ReadTimeout
-from concurrent.futures import ThreadPoolExecutor, as_completed # <--- NEW: Import concurrent futures
-from urllib.parse import urlparse
+from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, Future, FIRST_COMPLETED # <--- NEW: Import concurrent futures
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
 
 # ========== 配置区域 ==========
 DOMAIN = "theguardian.com/*"
 OUTPUT = "guardian_index_merged.jsonl"
 OUTPUT_DIR = "guardian_batches"
 INDEXES = ['CC-MAIN-2025-38', 'CC-MAIN-2025-33', 'CC-MAIN-2025-30', 'CC-MAIN-2025-26', 'CC-MAIN-2025-21', 'CC-MAIN-2025-18', 'CC-MAIN-2025-13', 'CC-MAIN-2025-08', 'CC-MAIN-2025-05', 'CC-MAIN-2024-51', 'CC-MAIN-2024-46', 'CC-MAIN-2024-42', 'CC-MAIN-2024-38', 'CC-MAIN-2024-33', 'CC-MAIN-2024-30', 'CC-MAIN-2024-26', 'CC-MAIN-2024-22', 'CC-MAIN-2024-18', 'CC-MAIN-2024-10', 'CC-MAIN-2023-50', 'CC-MAIN-2023-40', 'CC-MAIN-2023-23', 'CC-MAIN-2023-14', 'CC-MAIN-2023-06', 'CC-MAIN-2022-49', 'CC-MAIN-2022-40', 'CC-MAIN-2022-33', 'CC-MAIN-2022-27', 'CC-MAIN-2022-21', 'CC-MAIN-2022-05', 'CC-MAIN-2021-49', 'CC-MAIN-2021-43', 'CC-MAIN-2021-39', 'CC-MAIN-2021-31', 'CC-MAIN-2021-25', 'CC-MAIN-2021-21', 'CC-MAIN-2021-17', 'CC-MAIN-2021-10', 'CC-MAIN-2021-04', 'CC-MAIN-2020-50', 'CC-MAIN-2020-45', 'CC-MAIN-2020-40', 'CC-MAIN-2020-34', 'CC-MAIN-2020-29', 'CC-MAIN-2020-24', 'CC-MAIN-2020-16', 'CC-MAIN-2020-10', 'CC-MAIN-2020-05', 'CC-MAIN-2019-51', 'CC-MAIN-2019-47', 'CC-MAIN-2019-43', 'CC-MAIN-2019-39', 'CC-MAIN-2019-35', 'CC-MAIN-2019-30', 'CC-MAIN-2019-26', 'CC-MAIN-2019-22', 'CC-MAIN-2019-18', 'CC-MAIN-2019-13', 'CC-MAIN-2019-09', 'CC-MAIN-2019-04', 'CC-MAIN-2018-51', 'CC-MAIN-2018-47', 'CC-MAIN-2018-43', 'CC-MAIN-2018-39', 'CC-MAIN-2018-34', 'CC-MAIN-2018-30', 'CC-MAIN-2018-26', 'CC-MAIN-2018-22', 'CC-MAIN-2018-17', 'CC-MAIN-2018-13', 'CC-MAIN-2018-09', 'CC-MAIN-2018-05', 'CC-MAIN-2017-51', 'CC-MAIN-2017-47', 'CC-MAIN-2017-43', 'CC-MAIN-2017-39', 'CC-MAIN-2017-34', 'CC-MAIN-2017-30', 'CC-MAIN-2017-26', 'CC-MAIN-2017-22', 'CC-MAIN-2017-17', 'CC-MAIN-2017-13', 'CC-MAIN-2017-09', 'CC-MAIN-2017-04', 'CC-MAIN-2016-50', 'CC-MAIN-2016-44', 'CC-MAIN-2016-40', 'CC-MAIN-2016-36', 'CC-MAIN-2016-30', 'CC-MAIN-2016-26', 'CC-MAIN-2016-22', 'CC-MAIN-2016-18', 'CC-MAIN-2016-07', 'CC-MAIN-2015-48', 'CC-MAIN-2015-40', 'CC-MAIN-2015-35', 'CC-MAIN-2015-32', 'CC-MAIN-2015-27', 'CC-MAIN-2015-22', 'CC-MAIN-2015-18', 'CC-MAIN-2015-14', 'CC-MAIN-2015-11', 'CC-MAIN-2015-06', 'CC-MAIN-2014-52', 'CC-MAIN-2014-49', 'CC-MAIN-2014-42', 'CC-MAIN-2014-41', 'CC-MAIN-2014-35', 'CC-MAIN-2014-23', 'CC-MAIN-2014-15', 'CC-MAIN-2014-10', 'CC-MAIN-2013-48', 'CC-MAIN-2013-20', 'CC-MAIN-2012', 'CC-MAIN-2009-2010', 'CC-MAIN-2008-2009']
-MAX_WORKERS = 130  # <--- NEW: Number of parallel download threads
+MAX_WORKERS = 2  # 每个索引内部抓取分页的线程数
+INDEX_WORKERS = 4  # 同时处理的索引数
+# 安装了 aiohttp 时改用 asyncio 抓取：所有索引共享一个连接池，由信号量限制总并发
+USE_ASYNC = aiohttp is not None
+ASYNC_CONCURRENCY = 20
+READ_CHUNK_SIZE = 64 * 1024  # 读取分页响应的块大小
+HEDGE_AFTER = 15  # 单个分页超过这么多秒没有返回，就再发一个相同请求（对冲）
+# 线程版同时在途的对冲请求上限（含已被放弃、还没退出的）；名额用完时不再对冲，只等原请求
+MAX_HEDGES = INDEX_WORKERS
+NUM_PROCESSES = max(1, cpu_count() - 1)  # 合并阶段解析批次文件的进程数
+# 安装了 zstandard 时分页文件压缩保存为 .jsonl.zst，磁盘占用和合并阶段的读取量都小得多
+COMPRESS_BATCHES = zstd is not None
+ZSTD_LEVEL = 10
+# 合并结果是否也压缩成 OUTPUT + ".zst"；下游脚本读的是未压缩的 JSONL，所以默认关闭
+COMPRESS_OUTPUT = False
+NEGATIVE_CACHE_TTL = 3600  # 索引失败后这么多秒内重跑会直接跳过，避免反复走完整的重试+退避
+# 已发布的旧索引内容不会再变，总页数缓存到文件里，重跑时不再发 showNumPages 请求；
+# CURRENT_CRAWLS 中的索引每次仍然实时查询
+NUM_PAGES_CACHE = os.path.join(OUTPUT_DIR, "num_pages_cache.json")
+CURRENT_CRAWLS = set(INDEXES[:1])
+
+# 全局共享的 Session：复用 TCP+TLS 连接，避免每个请求都重新握手
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=INDEX_WORKERS, pool_maxsize=INDEX_WORKERS * MAX_WORKERS * 2, max_retries=0))
+SESSION.headers["Accept-Encoding"] = "gzip, deflate"
 
 # ========== 函数部分 ==========
 
+# 断点续传的粒度是分页：每页单独保存为 guardian_{idx}/p{page}.jsonl，
+# 所有分页都下载完成后再写入 guardian_{idx}.done 标记，表示该索引已封存。
+def index_dir_for(idx):
+    return os.path.join(OUTPUT_DIR, f"guardian_{idx}")
+
+def page_path_for(idx, page):
+    suffix = ".jsonl.zst" if COMPRESS_BATCHES else ".jsonl"
+    return os.path.join(index_dir_for(idx), f"p{page}{suffix}")
+
+def page_exists(idx, page):
+    """压缩或未压缩的分页文件任意一个存在即可（兼容切换 COMPRESS_BATCHES 前下载的分页）。"""
+    base = os.path.join(index_dir_for(idx), f"p{page}.jsonl")
+    return os.path.exists(base) or os.path.exists(base + ".zst")
+
+def done_path_for(idx):
+    return os.path.join(OUTPUT_DIR, f"guardian_{idx}.done")
+
+def legacy_batch_path_for(idx):
+    """旧版本每个索引只写一个 guardian_{idx}.jsonl，非空即视为已完成。"""
+    return os.path.join(OUTPUT_DIR, f"guardian_{idx}.jsonl")
+
+def is_index_done(idx):
+    if os.path.exists(done_path_for(idx)):
+        return True
+    # 旧版本请求失败时也会留下空文件，不能当作已完成，交给负缓存决定何时重试
+    try:
+        return os.path.getsize(legacy_batch_path_for(idx)) > 0
+    except OSError:
+        return False
+
+def save_page(idx, page, records):
+    """原子地写入单个分页文件（先写 .part 再 os.replace），重跑时不会读到半个文件。"""
+    page_path = page_path_for(idx, page)
+    tmp_path = page_path + ".part"
+    data = b"".join(orjson.dumps(rec) + b"\n" for rec in records)
+    if COMPRESS_BATCHES:
+        data = zstd.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, page_path)
+
+def open_batch(path):
+    """以二进制方式打开批次文件，.zst 文件透明解压。"""
+    if path.endswith(".zst"):
+        return io.BufferedReader(zstd.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    return open(path, "rb")
+
+def seal_index(idx):
+    open(done_path_for(idx), 'w').close()
+
+NUM_PAGES = {}
+NUM_PAGES_LOCK = threading.Lock()
+
+def load_num_pages_cache():
+    try:
+        with open(NUM_PAGES_CACHE, "rb") as f:
+            NUM_PAGES.update(orjson.loads(f.read()))
+    except (OSError, orjson.JSONDecodeError):
+        pass
+
+def cached_num_pages(idx):
+    """返回缓存的总页数；没有缓存或属于 CURRENT_CRAWLS 时返回 None。"""
+    if idx in CURRENT_CRAWLS or idx not in NUM_PAGES:
+        return None
+    return NUM_PAGES[idx]["pages"]
+
+def update_num_pages_cache(idx, num_pages):
+    """记录一次成功查询到的总页数，并原子地重写缓存文件。"""
+    with NUM_PAGES_LOCK:
+        NUM_PAGES[idx] = {"pages": num_pages}
+        tmp_path = NUM_PAGES_CACHE + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(NUM_PAGES))
+        os.replace(tmp_path, NUM_PAGES_CACHE)
+
+def status_path_for(idx):
+    return os.path.join(OUTPUT_DIR, f"guardian_{idx}.status")
+
+def is_recently_failed(idx):
+    """读取 guardian_{idx}.status 负缓存，失败记录还在 TTL 内则返回 True。"""
+    try:
+        with open(status_path_for(idx), "rb") as f:
+            status = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return False
+    return status.get("failed", False) and time.time() - status.get("ts", 0) < NEGATIVE_CACHE_TTL
+
+def record_failure(idx, code):
+    with open(status_path_for(idx), "wb") as f:
+        f.write(orjson.dumps({"failed": True, "ts": time.time(), "code": code}))
+
+def clear_failure(idx):
+    try:
+        os.remove(status_path_for(idx))
+    except FileNotFoundError:
+        pass
+
+def _extend_records(records, lines):
+    """把若干行 JSONL（bytes）解析后追加到 records，跳过空行和坏行。"""
+    for line in lines:
+        if line.strip():
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                continue
+
+def _fetch_page_once(page_url, cancelled):
+    """
+    发起一次分页请求，返回 (HTTP 状态码, 记录列表)。
+    如果 cancelled 被设置（对冲请求已经先完成），立即关闭连接并返回 (None, None)。
+    """
+    with SESSION.get(page_url, stream=True, timeout=600) as resp:
+        if resp.status_code != 200:
+            return resp.status_code, None
+        # 按 64 KB 大块读取再自行按换行切分，比 iter_lines() 逐行扫描快
+        lines = []
+        buf = b""
+        for chunk in resp.iter_content(chunk_size=READ_CHUNK_SIZE):
+            if cancelled.is_set():
+                return None, None
+            buf += chunk
+            *complete, buf = buf.split(b"\n")
+            _extend_records(lines, complete)
+        _extend_records(lines, [buf])
+        return 200, lines
+
+HEDGE_SLOTS = threading.BoundedSemaphore(MAX_HEDGES)
+
+def _submit_daemon(fn, *args, on_exit=None):
+    """
+    在守护线程中执行 fn 并返回 Future；线程结束时调用 on_exit。
+    被放弃的对冲请求可能还卡在等待响应头，用守护线程可以避免它拖住进程退出。
+    """
+    future = Future()
+    def runner():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            if on_exit is not None:
+                on_exit()
+    threading.Thread(target=runner, daemon=True).start()
+    return future
+
+def _hedged_fetch(page_url):
+    """
+    对冲请求：先发一个请求，HEDGE_AFTER 秒内没有完成就再发一个相同的请求，
+    取先成功的那个，另一个通过 cancelled 事件关闭连接。
+    对冲请求不占 MAX_WORKERS 的线程，总数由 HEDGE_SLOTS 限制，线程退出时才归还名额。
+    """
+    cancelled = threading.Event()
+    futures = [_submit_daemon(_fetch_page_once, page_url, cancelled)]
+    done, _ = wait(futures, timeout=HEDGE_AFTER)
+    if not done and HEDGE_SLOTS.acquire(blocking=False):
+        futures.append(_submit_daemon(_fetch_page_once, page_url, cancelled, on_exit=HEDGE_SLOTS.release))
+
+    pending = futures
+    try:
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and future.result()[0] == 200:
+                    return future.result()
+            if not pending:
+                # 所有请求都失败了：返回最后一个结果（或抛出它的异常）
+                return future.result()
+    finally:
+        cancelled.set()
+
 # NEW: Create a dedicated function to fetch a single page. This will be run in a thread.
 def fetch_page(page_url, page_num, retries=50, backoff=3):
     """
@@ -24,24 +239,17 @@ def fetch_page(page_url, page_num, retries=50, backoff=3):
     """
     for attempt in range(1, retries + 1):
         try:
-            with requests.get(page_url, stream=True, timeout=600) as resp:
-                if resp.status_code == 200:
-                    lines = []
-                    for line in resp.iter_lines():
-                        if line:
-                            try:
-                                lines.append(json.loads(line.decode('utf-8')))
-                            except json.JSONDecodeError:
-                                continue
-                    return lines # Success
-                else:
-                    # Don't print for every attempt, only if it's getting serious
-                    if attempt > 2:
-                        print(f"  -> Page {page_num}, attempt {attempt}: HTTP {resp.status_code}")
-                    if attempt == retries:
-                        print(f"❌ 访问页面 {page_num} 失败: HTTP {resp.status_code}")
-                        return None # Final failure
-                    time.sleep(backoff * attempt)
+            status_code, lines = _hedged_fetch(page_url)
+            if status_code == 200:
+                return lines # Success
+            else:
+                # Don't print for every attempt, only if it's getting serious
+                if attempt > 2:
+                    print(f"  -> Page {page_num}, attempt {attempt}: HTTP {status_code}")
+                if attempt == retries:
+                    print(f"❌ 访问页面 {page_num} 失败: HTTP {status_code}")
+                    return None # Final failure
+                time.sleep(backoff * attempt)
         except (ChunkedEncodingError, ConnectionError, ReadTimeout) as e:
             if attempt < retries:
                 time.sleep(backoff * attempt)
@@ -54,147 +262,424 @@ def fetch_page(page_url, page_num, retries=50, backoff=3):
 def fetch_from_index(index_name, domain, retries=50, backoff=3):
     """
     从 Common Crawl Index 并行查询指定域名的记录。
-    如果任何一个分页下载失败，则整个索引的下载任务失败，返回空列表。
+    每页下载成功后立即写盘，已存在的分页会被跳过；全部分页完成后封存该索引。
+    返回 (是否完成, 总页数, 本次失败的页数, 查询总页数时的 HTTP 状态码)。
     """
     base_url = f"https://index.commoncrawl.org/{index_name}-index?url={domain}&output=json"
-    
-    # 1. 查询总页数 (remains the same)
+    os.makedirs(index_dir_for(index_name), exist_ok=True)
+    failed_pages = 0
+
+    # 2. NEW: Use ThreadPoolExecutor to fetch pages in parallel
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # 第 0 页无论总页数是多少都要抓，和查询总页数的请求同时发出，
+        # 只有 1 页的索引因此省掉一次往返
+        futures = {}
+        if not page_exists(index_name, 0):
+            futures[executor.submit(fetch_page, f"{base_url}&page=0", 0, retries, backoff)] = 0
+
+        # 查询总页数（与第 0 页并行）
+        num_pages, probe_status, pages_known = _probe_num_pages(index_name, base_url)
+
+        # Create a future for each remaining page download
+        for page in range(1, num_pages):
+            if not page_exists(index_name, page):
+                futures[executor.submit(fetch_page, f"{base_url}&page={page}", page, retries, backoff)] = page
+
+        # Process results as they complete, with a progress bar
+        progress = tqdm(as_completed(futures), total=len(futures), desc=f"  {index_name} 抓取页面", unit="页", leave=False)
+        for future in progress:
+            page_result = future.result()
+            if page_result is not None:
+                save_page(index_name, futures[future], page_result)
+            else:
+                # 失败的分页不写文件，下次运行时只重新下载这些分页
+                failed_pages += 1
+
+    # 总页数是查询失败时猜的 1 页时，磁盘上的分页不一定齐全，不能封存，按失败处理，过了负缓存期后重试
+    if failed_pages or not pages_known:
+        return False, num_pages, failed_pages, probe_status
+
+    seal_index(index_name)
+    return True, num_pages, 0, probe_status
+
+def _probe_num_pages(index_name, base_url):
+    """
+    查询索引的总页数，返回 (总页数, HTTP 状态码, 总页数是否可靠)。
+    命中缓存时状态码为 None；查询失败时按 1 页处理，但标记为不可靠，调用方不会据此封存索引。
+    """
+    num_pages = cached_num_pages(index_name)
+    if num_pages is not None:
+        return num_pages, None, True
+
     num_pages = 1
+    probe_status = None
     try:
         page_check_url = f"{base_url}&showNumPages=true"
         print(f"正在查询 {index_name} 的总页数...")
-        resp = requests.get(page_check_url, timeout=600)
+        resp = SESSION.get(page_check_url, timeout=600)
+        probe_status = resp.status_code
         if resp.status_code == 200:
-            page_info = json.loads(resp.text.strip().splitlines()[0])
+            page_info = orjson.loads(resp.content.strip().splitlines()[0])
             num_pages = page_info.get("pages", 1)
+            update_num_pages_cache(index_name, num_pages)
             print(f"  -> {index_name} 共有 {num_pages} 页")
+            return num_pages, probe_status, True
         else:
             print(f"⚠️ 无法获取 {index_name} 的总页数，将只尝试抓取第1页。状态码: {resp.status_code}")
     except Exception as e:
         print(f"⚠️ 查询总页数时出错: {e}，将只尝试抓取第1页。")
+    return num_pages, probe_status, False
 
-    all_records = []
-    has_failed = False
+async def _fetch_page_once_async(session, sem, page_url, sent=None):
+    """_fetch_page_once 的 asyncio 版本，返回 (HTTP 状态码, 记录列表)；拿到信号量、即将发出请求时设置 sent。"""
+    async with sem:
+        if sent is not None:
+            sent.set()
+        async with session.get(page_url) as resp:
+            if resp.status != 200:
+                return resp.status, None
+            lines = []
+            buf = b""
+            async for chunk in resp.content.iter_chunked(READ_CHUNK_SIZE):
+                buf += chunk
+                *complete, buf = buf.split(b"\n")
+                _extend_records(lines, complete)
+            _extend_records(lines, [buf])
+            return 200, lines
 
-    # 2. NEW: Use ThreadPoolExecutor to fetch pages in parallel
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Create a future for each page download
-        futures = {
-            executor.submit(fetch_page, f"{base_url}&page={page}", page, retries, backoff): page
-            for page in range(num_pages)
-        }
+async def _hedged_fetch_async(session, sem, page_url):
+    """_hedged_fetch 的 asyncio 版本：落后的请求直接 cancel，连接随之关闭。"""
+    sent = asyncio.Event()
+    tasks = [asyncio.create_task(_fetch_page_once_async(session, sem, page_url, sent))]
+    pending = tasks
+    try:
+        # 排队等信号量的时间不算，HEDGE_AFTER 从请求真正发出时开始计
+        await sent.wait()
+        done, _ = await asyncio.wait(tasks, timeout=HEDGE_AFTER)
+        if not done:
+            tasks.append(asyncio.create_task(_fetch_page_once_async(session, sem, page_url)))
 
-        # Process results as they complete, with a progress bar
-        progress = tqdm(as_completed(futures), total=num_pages, desc=f"  抓取页面", unit="页")
-        for future in progress:
-            page_result = future.result()
-            if page_result is not None:
-                all_records.extend(page_result)
+        pending = tasks
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result()[0] == 200:
+                    return task.result()
+            if not pending:
+                return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def fetch_page_async(session, sem, page_url, page_num, retries=50, backoff=3):
+    """fetch_page 的 asyncio 版本，并发数由共享的信号量 sem 限制。"""
+    for attempt in range(1, retries + 1):
+        try:
+            status, lines = await _hedged_fetch_async(session, sem, page_url)
+            if status == 200:
+                return lines
+            if attempt > 2:
+                print(f"  -> Page {page_num}, attempt {attempt}: HTTP {status}")
+            if attempt == retries:
+                print(f"❌ 访问页面 {page_num} 失败: HTTP {status}")
+                return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                print(f"❌ 放弃页面 {page_num}（多次网络失败: {e}）")
+                return None
+        await asyncio.sleep(backoff * attempt)
+    return None
+
+async def _probe_num_pages_async(session, sem, index_name, base_url):
+    """_probe_num_pages 的 asyncio 版本，返回值相同。"""
+    num_pages = cached_num_pages(index_name)
+    if num_pages is not None:
+        return num_pages, None, True
+
+    num_pages = 1
+    probe_status = None
+    try:
+        async with sem, session.get(f"{base_url}&showNumPages=true") as resp:
+            probe_status = resp.status
+            if resp.status == 200:
+                page_info = orjson.loads((await resp.read()).strip().splitlines()[0])
+                num_pages = page_info.get("pages", 1)
+                update_num_pages_cache(index_name, num_pages)
+                return num_pages, probe_status, True
             else:
-                # If any page fails, we mark the whole index as failed.
-                has_failed = True
-                # Optional: Cancel remaining jobs to fail faster
-                # executor.shutdown(wait=False, cancel_futures=True) 
-                print(f"\n❌ 索引 {index_name} 的一个页面下载失败，将中止该索引的抓取。")
-                break # Exit the loop immediately
+                print(f"⚠️ 无法获取 {index_name} 的总页数，将只尝试抓取第1页。状态码: {resp.status}")
+    except Exception as e:
+        print(f"⚠️ 查询 {index_name} 总页数时出错: {e}，将只尝试抓取第1页。")
+    return num_pages, probe_status, False
+
+async def fetch_from_index_async(session, sem, index_name, domain, retries=50, backoff=3):
+    """fetch_from_index 的 asyncio 版本，返回值相同。"""
+    base_url = f"https://index.commoncrawl.org/{index_name}-index?url={domain}&output=json"
+    os.makedirs(index_dir_for(index_name), exist_ok=True)
+
+    async def fetch_and_save(page):
+        page_result = await fetch_page_async(session, sem, f"{base_url}&page={page}", page, retries, backoff)
+        if page_result is None:
+            return False
+        save_page(index_name, page, page_result)
+        return True
 
-    if has_failed:
-        return [] # Return empty list if any page failed, preserving original logic
+    # 第 0 页与查询总页数的请求并行发出
+    tasks = []
+    if not page_exists(index_name, 0):
+        tasks.append(asyncio.ensure_future(fetch_and_save(0)))
 
-    return all_records
+    num_pages, probe_status, pages_known = await _probe_num_pages_async(session, sem, index_name, base_url)
+
+    tasks.extend(fetch_and_save(page) for page in range(1, num_pages) if not page_exists(index_name, page))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failed_pages = sum(1 for ok in results if ok is not True)
+    # 总页数是查询失败时猜的 1 页时，磁盘上的分页不一定齐全，不能封存，按失败处理，过了负缓存期后重试
+    if failed_pages or not pages_known:
+        return False, num_pages, failed_pages, probe_status
+
+    seal_index(index_name)
+    return True, num_pages, 0, probe_status
 
 # ========== 主流程 ==========
-# (The main loop and merging/deduplication logic remain unchanged)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-for idx in INDEXES:
-    batch_path = os.path.join(OUTPUT_DIR, f"guardian_{idx}.jsonl")
-    if os.path.exists(batch_path):
-        print(f"✅ 跳过 {idx}（已存在）")
-        continue
-
-    print(f"\n===== 开始处理索引: {idx} =====")
-    recs = fetch_from_index(idx, DOMAIN)
-    
-    if not recs:
-        print(f"❌ {idx} 未抓取到任何记录或下载失败，跳过保存。")
-        open(batch_path, 'w').close() # Create an empty file to mark as processed
-        continue
-
-    print(f"  -> {idx} 共抓取 {len(recs)} 条记录")
-
-    with open(batch_path, "w", encoding="utf-8") as f:
-        for rec in recs:
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
-    print(f"✅ 已保存到 {batch_path}")
-
-
-print("\n🧩 所有批次已抓取并分别保存。开始合并...")
-
-# ========== 合并 ==========
-all_records = []
-for fname in tqdm(os.listdir(OUTPUT_DIR), desc="加载批次"):
-    if not fname.endswith(".jsonl"):
-        continue
-    file_path = os.path.join(OUTPUT_DIR, fname)
-    # Check if the file is empty before trying to read from it
-    if os.path.getsize(file_path) > 0:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                try:
-                    all_records.append(json.loads(line))
-                except json.JSONDecodeError:
-                    continue
-
-print(f"共加载 {len(all_records)} 条记录，正在去重...")
-
-
-# ========== 去重 ==========
-# (No changes needed here)
-def normalize_url(url: str) -> str:
-    try:
-        parsed = urlparse(url)
-        netloc = parsed.netloc.lower()
-        if netloc.startswith("www."):
-            netloc = netloc[4:]
-        path = parsed.path.rstrip("/")
-        return f"{netloc}{path}"
-    except:
-        return url
-
-def choose_better_record(old, new):
-    if old.get("status") != "200" and new.get("status") == "200": return new
-    if old.get("status") == "200" and new.get("status") != "200": return old
-    old_html = "html" in (old.get("mime-detected", "") or "").lower()
-    new_html = "html" in (new.get("mime-detected", "") or "").lower()
-    if old_html and not new_html: return old
-    if not old_html and new_html: return new
+def record_result(idx, result):
+    """根据抓取结果更新负缓存，返回状态字符串。"""
+    completed, num_pages, failed_pages, probe_status = result
+    if completed:
+        clear_failure(idx)
+        return f"{num_pages} 页全部完成，已保存到 {index_dir_for(idx)}"
+    record_failure(idx, probe_status)
+    if not failed_pages:
+        return f"⚠️ 未能查询到总页数，暂不封存，{NEGATIVE_CACHE_TTL} 秒后重跑时重新查询"
+    return f"❌ {failed_pages}/{num_pages} 页下载失败，{NEGATIVE_CACHE_TTL} 秒后重跑时将只重试这些分页"
+
+def should_skip(idx):
+    """返回跳过原因；需要抓取时返回 None。"""
+    if is_index_done(idx):
+        return "已完成，跳过"
+    if is_recently_failed(idx):
+        return "最近失败过，仍在负缓存有效期内，跳过"
+    return None
+
+def process_index(idx):
+    """抓取单个索引，返回 (idx, 状态字符串)。"""
+    skip_reason = should_skip(idx)
+    if skip_reason:
+        return idx, skip_reason
+    return idx, record_result(idx, fetch_from_index(idx, DOMAIN))
+
+async def process_all_indexes_async(indexes):
+    """用一个共享的 aiohttp ClientSession 抓取所有索引。"""
+    connector = aiohttp.TCPConnector(limit=ASYNC_CONCURRENCY, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=600)
+    sem = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    index_sem = asyncio.Semaphore(INDEX_WORKERS)
+
+    async def process_one(idx):
+        async with index_sem:
+            result = await fetch_from_index_async(session, sem, idx, DOMAIN)
+        return idx, record_result(idx, result)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers={"Accept-Encoding": "gzip, deflate"}) as session:
+        pending = [process_one(idx) for idx in indexes if not should_skip(idx)]
+        for coro in tqdm(asyncio.as_completed(pending), total=len(pending), desc="处理索引", unit="个"):
+            idx, message = await coro
+            tqdm.write(f"  -> {idx}: {message}")
+
+def main_downloader():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    load_num_pages_cache()
+
+    if USE_ASYNC:
+        asyncio.run(process_all_indexes_async(INDEXES))
+    else:
+        # 多个索引同时抓取；每个索引内部再用 MAX_WORKERS 个线程抓分页，
+        # 总并发约为 INDEX_WORKERS * MAX_WORKERS，避免触发 429
+        with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as index_executor:
+            index_futures = [index_executor.submit(process_index, idx) for idx in INDEXES]
+            for future in tqdm(as_completed(index_futures), total=len(index_futures), desc="处理索引", unit="个"):
+                idx, message = future.result()
+                tqdm.write(f"  -> {idx}: {message}")
+
+# ========== 合并与去重 ==========
+# 边读边去重：不再把所有批次的记录先放进一个大列表
+def list_batch_files(batch_dir):
+    """
+    列出所有可以参与合并的非空批次文件：旧版的单文件批次，以及已封存索引目录下的分页文件。
+    返回按路径排序的 [(路径, 文件大小), ...]；os.scandir 自带 stat 缓存，不用再逐个 getsize。
+    """
+    batch_files = []
+    for entry in os.scandir(batch_dir):
+        if entry.name.endswith(".jsonl") and entry.is_file():
+            batch_files.append((entry.path, entry.stat().st_size))
+        elif entry.name.endswith(".done"):
+            index_dir = entry.path[:-len(".done")]
+            if os.path.isdir(index_dir):
+                batch_files.extend(
+                    (page.path, page.stat().st_size)
+                    for page in os.scandir(index_dir) if page.name.endswith((".jsonl", ".jsonl.zst"))
+                )
+    # 按路径排序，文件编号（以及最终输出的顺序）不依赖目录遍历的返回顺序
+    return sorted(f for f in batch_files if f[1] > 0)
+
+# 去重字典里只保存比较所需的质量元组和记录在批次文件中的位置：
+# ((status 是否为 200, 是否 HTML, length, timestamp), 文件编号, 字节偏移)
+# 完整记录只在最后写出时按位置从批次文件中重新读取。
+def record_summary(rec, file_id, offset):
     try:
-        if int(new.get("length", 0)) > int(old.get("length", 0)): return new
-    except (ValueError, TypeError): pass
-    if new.get("timestamp", "") > old.get("timestamp", ""): return new
-    return old
+        length = int(rec.get("length") or 0)
+    except (ValueError, TypeError):
+        length = 0
+    quality = (
+        rec.get("status") == "200",
+        "html" in (rec.get("mime-detected", "") or "").lower(),
+        length,
+        rec.get("timestamp", ""),
+    )
+    return quality, file_id, offset
 
-def deduplicate_records(records):
-    unique = {}
-    for rec in tqdm(records, desc="去重中"):
+def parse_batch(job):
+    """
+    在子进程中解析一个批次文件，返回 [(规范化URL的哈希, 记录摘要), ...]。
+    job 是 (文件编号, 文件路径)。
+    """
+    file_id, file_path = job
+    entries = []
+    if file_path.endswith(".zst"):
+        # 单个分页解压后也只有几 MB，整块解压后按同样的方式切分
+        with open_batch(file_path) as f:
+            _parse_lines(f.read(), file_id, entries)
+    else:
+        # 内存映射整个文件，直接在字节上找换行，切片交给 orjson
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            _parse_lines(mm, file_id, entries)
+    return entries
+
+def _parse_lines(buf, file_id, entries):
+    """在 bytes 或 mmap 上按换行切分并解析，偏移量是解压后数据中的字节位置。"""
+    start, size = 0, len(buf)
+    while start < size:
+        nl = buf.find(b"\n", start)
+        if nl < 0:
+            nl = size
+        line_offset, line = start, buf[start:nl]
+        start = nl + 1
+        try:
+            rec = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            continue
         url = rec.get("url")
-        if not url: continue
-        key = normalize_url(url)
-        if key in unique:
-            unique[key] = choose_better_record(unique[key], rec)
-        else:
-            unique[key] = rec
-    return list(unique.values())
+        if url:
+            entries.append((url_key(normalize_url(url)), record_summary(rec, file_id, line_offset)))
+
+def normalize_url(url: str) -> str:
+    """
+    手写的 URL 规范化：域名小写、去掉 www.、去掉末尾斜杠，丢弃查询串、锚点和 params。
+    结果与原来基于 urlparse 的版本相同，但不用构造 ParseResult，去重循环快很多。
+    """
+    i = url.find("://")
+    rest = url[i + 3:] if i >= 0 else url
+    end = len(rest)
+    for sep in "?#":
+        k = rest.find(sep)
+        if 0 <= k < end:
+            end = k
+    j = rest.find("/", 0, end)
+    if j < 0:
+        j = end
+    # urlparse 会把最后一段路径里 ";" 之后的部分当作 params 去掉
+    k = rest.find(";", rest.rfind("/", j, end), end)
+    if k >= 0:
+        end = k
+    netloc = rest[:j].lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    return netloc + rest[j:end].rstrip("/")
+
+# 去重字典的键用规范化 URL 的 64 位哈希（int）代替字符串本身，每个键省下几十字节。
+# 一千万个 URL 发生碰撞的概率约为 3e-6，可以忽略。
+if xxhash is not None:
+    def url_key(norm_url):
+        return xxhash.xxh64_intdigest(norm_url)
+else:
+    def url_key(norm_url):
+        return int.from_bytes(hashlib.blake2b(norm_url.encode("utf-8"), digest_size=8).digest(), "little")
+
+def deduplicate_records(entries, existing_map=None):
+    """
+    entries 是 (规范化URL的哈希, 摘要) 的可迭代对象，合并进 existing_map（默认新建）并返回。
+    """
+    unique = existing_map if existing_map is not None else {}
+    # 热循环：把方法绑定到局部变量，每条记录只查一次字典
+    # 质量元组按字典序比较（在 C 里完成）：200 优先，其次 HTML，再次更长，最后更新；
+    # 完全相同时保留先出现的记录
+    get = unique.get
+    for key, summary in entries:
+        old = get(key)
+        if old is None or summary[0] > old[0]:
+            unique[key] = summary
+    return unique
+
+def main_merge_and_deduplicate():
+    batch_files_with_size = list_batch_files(OUTPUT_DIR)
+    batch_files = [path for path, _ in batch_files_with_size]
+    # 大文件先处理，避免进程池最后只剩一个大文件在跑
+    jobs = sorted(enumerate(batch_files), key=lambda job: batch_files_with_size[job[0]][1], reverse=True)
+
+    # 各批次文件互相独立：多进程并行解析和计算哈希，主进程只负责合并。
+    # 用 imap 按提交顺序合并，完全相同的记录之间的取舍不受进程完成顺序影响
+    unique = {}
+    with Pool(processes=NUM_PROCESSES) as pool:
+        results_iterator = pool.imap(parse_batch, jobs)
+        for entries in tqdm(results_iterator, total=len(batch_files), desc="加载批次"):
+            deduplicate_records(entries, existing_map=unique)
+    print(f"✅ 去重后剩余 {len(unique)} 条唯一记录")
+
+    # ========== 保存 ==========
+    # 按 (文件编号, 偏移) 排序后顺序读取，每个批次文件只打开一次。
+    # 偏移递增，所以压缩文件也只需顺序解压、跳过中间的字节，不需要随机访问；未压缩的文件直接 seek。
+    # 索引分页内的记录本身按 urlkey 排好序，因此输出顺序是确定的，且相近的 URL 挨在一起
+    locations = sorted(summary[1:] for summary in unique.values())
+    del unique
+    output_path = OUTPUT + ".zst" if COMPRESS_OUTPUT and zstd is not None else OUTPUT
+    with open(output_path, "wb") as raw:
+        f = zstd.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw) if output_path.endswith(".zst") else raw
+        current_file_id, batch_file, pos, seekable = None, None, 0, False
+        for file_id, offset in locations:
+            if file_id != current_file_id:
+                if batch_file:
+                    batch_file.close()
+                current_file_id, batch_file, pos = file_id, open_batch(batch_files[file_id]), 0
+                seekable = not batch_files[file_id].endswith(".zst")
+            if seekable:
+                if pos != offset:
+                    batch_file.seek(offset)
+                    pos = offset
+            else:
+                while pos < offset:
+                    chunk = batch_file.read(min(offset - pos, READ_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    pos += len(chunk)
+            line = batch_file.readline()
+            # 读不到记录说明批次文件在解析之后被截断或改写过，继续下去只会写出错位的数据
+            if pos != offset or not line:
+                raise RuntimeError(f"批次文件 '{batch_files[file_id]}' 在偏移 {offset} 处没有记录，可能在解析后被截断或改写")
+            pos += len(line)
+            f.write(line if line.endswith(b"\n") else line + b"\n")
+        if batch_file:
+            batch_file.close()
+        if f is not raw:
+            f.flush(zstd.FLUSH_FRAME)
 
+    print(f"\n✅ 已合并并保存到 {output_path}")
+    print("下一步：可使用正文下载脚本提取网页内容。")
 
-merged = deduplicate_records(all_records)
-print(f"✅ 去重后剩余 {len(merged)} 条唯一记录")
 
-# ========== 保存 ==========
-with open(OUTPUT, "w", encoding="utf-8") as f:
-    for rec in merged:
-        f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+if __name__ == "__main__":
+    main_downloader()
 
-print(f"\n✅ 已合并并保存到 {OUTPUT}")
-print("下一步：可使用正文下载脚本提取网页内容。")
\ No newline at end of file
+    print("\n🧩 所有批次已抓取并分别保存。开始合并...")
+    main_merge_and_deduplicate()
\ No newline at end of file
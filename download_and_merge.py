@@ -1,13 +1,24 @@
 # 2_download_and_merge.py
-import json
 import os
+import re
+import mmap
+import orjson
+import asyncio
 import requests
 import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from tqdm import tqdm
 from requests.exceptions import RequestException
+from multiprocessing import Pool, cpu_count
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 # ========== 配置区域 ==========
 # 此处配置应与脚本1保持一致，或只保留下载和输出相关配置
 OUTPUT = "guardian_index_merged.jsonl"
@@ -17,9 +28,41 @@ COMPLETED_LOG_FILE = "completed_tasks.log"
 
 MAX_WORKERS = 1
 REQUEST_TIMEOUT = 30
+# 安装了 aiohttp 时改用 asyncio 下载：所有请求在一个线程里并发，由信号量限制为 MAX_WORKERS 个
+USE_ASYNC = aiohttp is not None
+# 合并阶段解析批次文件的进程数
+NUM_PROCESSES = max(1, cpu_count() - 1)
+# 写合并结果时每攒够这么多条记录才调用一次 write()
+WRITE_CHUNK_SIZE = 4096
+# 服务器要求的 Retry-After 最多等待这么多秒
+MAX_RETRY_AFTER = 300
+# 是否把每个页面单独保存到 OUTPUT_DIR（调试用）。
+# 关闭时下载到的记录直接在内存中去重，每轮结束后写出 OUTPUT 再记录完成的任务，
+# 不再先写一遍分页文件、合并阶段再全部读回来解析一遍
+SAVE_RAW_PAGES = False
+# 关闭 SAVE_RAW_PAGES 时，以前保存的分页文件并入 OUTPUT 后移到这里，之后每次运行不再重新解析
+FOLDED_PAGES_DIR = os.path.join(OUTPUT_DIR, "folded")
 
 # ========== 下载函数 (无变动) ==========
 
+def retry_after_delay(headers, default):
+    """
+    服务器在 429/503 等响应里给出 Retry-After 时按它的要求等待（秒数或 HTTP 日期），
+    否则使用默认的退避时间。
+    """
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return default
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return default
+    return min(max(delay, 0), MAX_RETRY_AFTER)
+
+
 def fetch_page(session, task):
     """
     Fetches a single page of results.
@@ -38,15 +81,15 @@ def fetch_page(session, task):
                     for line in resp.iter_lines():
                         if line:
                             try:
-                                lines.append(json.loads(line.decode('utf-8')))
-                            except json.JSONDecodeError:
+                                lines.append(orjson.loads(line))
+                            except orjson.JSONDecodeError:
                                 continue
                     return (task, lines)
                 else:
                     error_msg = f"HTTP {resp.status_code}"
                     if resp.status_code in [404, 400]:
                         return (task, f"Fatal error: {error_msg}")
-                    time.sleep(backoff * attempt)
+                    time.sleep(retry_after_delay(resp.headers, backoff * attempt))
         except RequestException as e:
             error_msg = str(e)
             time.sleep(backoff * attempt)
@@ -54,6 +97,48 @@ def fetch_page(session, task):
     return (task, f"Failed after {retries} attempts: {error_msg}")
 
 
+async def fetch_page_async(session, sem, task):
+    """fetch_page 的 asyncio 版本，返回值相同。重试等待期间不占用并发名额。"""
+    page_url = task['url']
+    retries = 5
+    backoff = 3
+    error_msg = None
+
+    for attempt in range(1, retries + 1):
+        delay = backoff * attempt
+        try:
+            async with sem, session.get(page_url) as resp:
+                if resp.status == 200:
+                    lines = []
+                    async for line in resp.content:
+                        line = line.strip()
+                        if line:
+                            try:
+                                lines.append(orjson.loads(line))
+                            except orjson.JSONDecodeError:
+                                continue
+                    return (task, lines)
+                error_msg = f"HTTP {resp.status}"
+                if resp.status in [404, 400]:
+                    return (task, f"Fatal error: {error_msg}")
+                delay = retry_after_delay(resp.headers, delay)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error_msg = str(e)
+        await asyncio.sleep(delay)
+
+    return (task, f"Failed after {retries} attempts: {error_msg}")
+
+
+async def download_round_async(tasks, handle_result):
+    """用一个共享的 aiohttp ClientSession 下载一轮任务，每完成一个就调用 handle_result(task, result)。"""
+    connector = aiohttp.TCPConnector(limit=MAX_WORKERS * 4, limit_per_host=MAX_WORKERS)
+    timeout = aiohttp.ClientTimeout(sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+    sem = asyncio.Semaphore(MAX_WORKERS)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        for coro in asyncio.as_completed([fetch_page_async(session, sem, task) for task in tasks]):
+            handle_result(*(await coro))
+
+
 def main_downloader():
     """
     下载器主流程，具备断点续传和自动重试功能。
@@ -71,9 +156,9 @@ def main_downloader():
 
     print("正在加载任务列表...")
     all_tasks = {}
-    with open(TASKS_FILE, 'r', encoding='utf-8') as f:
+    with open(TASKS_FILE, 'rb') as f:
         for line in f:
-            task = json.loads(line)
+            task = orjson.loads(line)
             task_id = f"{task['index']}_{task['page']}"
             all_tasks[task_id] = task
     
@@ -83,10 +168,11 @@ def main_downloader():
     # 1. 通过扫描输出目录下的文件来确定已完成任务
     print(f"正在扫描目录 '{OUTPUT_DIR}' 以检测已下载的文件...")
     if os.path.isdir(OUTPUT_DIR):
-        for filename in os.listdir(OUTPUT_DIR):
-            if filename.startswith("page_") and filename.endswith(".jsonl"):
-                filepath = os.path.join(OUTPUT_DIR, filename)
-                if os.path.getsize(filepath) > 0:
+        # os.scandir 逐个产出 DirEntry，文件大小从 DirEntry.stat() 取，不再对每个文件拼路径再 getsize
+        with os.scandir(OUTPUT_DIR) as it:
+            for entry in it:
+                filename = entry.name
+                if filename.startswith("page_") and filename.endswith(".jsonl") and entry.stat().st_size > 0:
                     task_id = filename[5:-6] 
                     completed_tasks_ids.add(task_id)
     print(f"通过扫描文件，找到 {len(completed_tasks_ids)} 个已完成的任务。")
@@ -103,6 +189,17 @@ def main_downloader():
 
     tasks_to_do = [task for task_id, task in all_tasks.items() if task_id not in completed_tasks_ids]
 
+    unique = None
+    if not SAVE_RAW_PAGES:
+        # 在上次合并结果的基础上继续去重；以前保存的分页文件只在这里并入一次
+        raw_paths = list_batch_paths()
+        if tasks_to_do or raw_paths:
+            sources = ([OUTPUT] if os.path.exists(OUTPUT) else []) + raw_paths
+            unique = load_unique(sources) if sources else {}
+            if raw_paths:
+                write_merged(unique, OUTPUT)
+                fold_batch_files(raw_paths)
+
     if not tasks_to_do:
         print("✅ 所有任务均已下载完成！")
         return True
@@ -127,44 +224,57 @@ def main_downloader():
             # 【新增】本轮成功/失败计数器
             success_this_run = 0
             failures_this_run = 0
-            
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                future_to_task = {executor.submit(fetch_page, session, task): task for task in tasks_to_do}
-                progress = tqdm(as_completed(future_to_task), total=len(tasks_to_do), desc=f"下载中 (第 {attempt} 轮)")
-                
-                tasks_completed_this_batch = []
+            tasks_completed_this_batch = []
+            progress = tqdm(total=len(tasks_to_do), desc=f"下载中 (第 {attempt} 轮)")
 
-                for future in progress:
-                    task_done, result = future.result()
-                    task_id = f"{task_done['index']}_{task_done['page']}"
+            def handle_result(task_done, result):
+                nonlocal success_this_run, failures_this_run
+                task_id = f"{task_done['index']}_{task_done['page']}"
+                
+                if isinstance(result, list) and unique is not None:
+                    deduplicate_records(result, unique)
+                    tasks_completed_this_batch.append(task_id)
+                    success_this_run += 1
+                elif isinstance(result, list):
+                    page_filename = f"page_{task_id}.jsonl"
+                    page_filepath = os.path.join(OUTPUT_DIR, page_filename)
                     
-                    if isinstance(result, list):
-                        page_filename = f"page_{task_id}.jsonl"
-                        page_filepath = os.path.join(OUTPUT_DIR, page_filename)
-                        
-                        try:
-                            with open(page_filepath, "w", encoding="utf-8") as f:
-                                for rec in result:
-                                    f.write(json.dumps(rec, ensure_ascii=False) + "\n")
-                            tasks_completed_this_batch.append(task_id)
-                            # 【修改】更新成功计数
-                            success_this_run += 1
-                        except IOError:
-                            tasks_failed_this_run.append(task_done)
-                            # 【修改】更新失败计数
-                            failures_this_run += 1
-                    else:
+                    try:
+                        # 整页记录拼成一个 bytes，一次 write() 写入
+                        with open(page_filepath, "wb") as f:
+                            f.write(b"".join(orjson.dumps(rec) + b"\n" for rec in result))
+                        tasks_completed_this_batch.append(task_id)
+                        # 【修改】更新成功计数
+                        success_this_run += 1
+                    except IOError:
                         tasks_failed_this_run.append(task_done)
                         # 【修改】更新失败计数
                         failures_this_run += 1
-                    
-                    # 【修改】更新进度条后缀，显示实时计数
-                    progress.set_postfix_str(f"成功: {success_this_run}, 失败: {failures_this_run}")
+                else:
+                    tasks_failed_this_run.append(task_done)
+                    # 【修改】更新失败计数
+                    failures_this_run += 1
+                
+                # 【修改】更新进度条后缀，显示实时计数
+                progress.update(1)
+                progress.set_postfix_str(f"成功: {success_this_run}, 失败: {failures_this_run}")
+
+            if USE_ASYNC:
+                asyncio.run(download_round_async(tasks_to_do, handle_result))
+            else:
+                with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                    future_to_task = {executor.submit(fetch_page, session, task): task for task in tasks_to_do}
+                    for future in as_completed(future_to_task):
+                        handle_result(*future.result())
+            progress.close()
             
             # 【新增】打印本轮的总结
             print(f"\n本轮结果: {success_this_run} 个成功, {failures_this_run} 个失败。")
 
             if tasks_completed_this_batch:
+                # 先写出合并结果，再记录完成的任务：中途退出时日志里不会有未落盘的页面
+                if unique is not None:
+                    write_merged(unique, OUTPUT)
                 print(f"正在记录 {len(tasks_completed_this_batch)} 个成功任务的进度...")
                 for task_id in tasks_completed_this_batch:
                     log_file.write(task_id + "\n")
@@ -184,7 +294,18 @@ def main_downloader():
     return True
 
 # ========== 合并与去重函数 (无变动) ==========
+# 常见的 "scheme://netloc/path?query#fragment" 形式用一个预编译正则处理，
+# 比每条记录构造一次 urlparse 的 ParseResult 快得多
+_URL_RE = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*://([^/?#\[\]\s]*)(?=[/?#]|$)([^?#;\s]*)(?=[?#]|$)')
+
 def normalize_url(url: str) -> str:
+    m = _URL_RE.match(url)
+    # 带 IPv6 方括号的域名、空白字符、路径里带 ";"（urlparse 会拆出 params）等少见情况交给下面的原始逻辑
+    if m:
+        netloc = m.group(1).lower()
+        if netloc.startswith("www."):
+            netloc = netloc[4:]
+        return netloc + m.group(2).rstrip("/")
     try:
         parsed = urlparse(url)
         netloc = parsed.netloc.lower()
@@ -195,67 +316,149 @@ def normalize_url(url: str) -> str:
     except:
         return url
 
-def choose_better_record(old, new):
-    if old.get("status") != "200" and new.get("status") == "200": return new
-    if old.get("status") == "200" and new.get("status") != "200": return old
-    old_html = "html" in (old.get("mime-detected", "") or "").lower()
-    new_html = "html" in (new.get("mime-detected", "") or "").lower()
-    if old_html and not new_html: return old
-    if not old_html and new_html: return new
+def record_quality(rec):
+    """
+    每条记录只计算一次的质量元组，按字典序比较：200 优先，其次 HTML，再次更长，最后更新。
+    取代原来每次比较都重新 .get()/.lower()/int() 的 choose_better_record。
+    """
     try:
-        if int(new.get("length", 0)) > int(old.get("length", 0)): return new
-    except (ValueError, TypeError): pass
-    if new.get("timestamp", "") > old.get("timestamp", ""): return new
-    return old
+        length = int(rec.get("length") or 0)
+    except (ValueError, TypeError):
+        length = 0
+    return (
+        rec.get("status") == "200",
+        "html" in (rec.get("mime-detected", "") or "").lower(),
+        length,
+        rec.get("timestamp", ""),
+    )
 
-def deduplicate_records(records):
-    unique = {}
-    for rec in tqdm(records, desc="去重中"):
+def deduplicate_records(records, unique=None):
+    """
+    records 可以是任意可迭代对象（包括生成器），返回 {规范化URL: (质量元组, 最佳记录)}。
+    传入 unique 时合并进这个字典。
+    """
+    if unique is None:
+        unique = {}
+    for rec in records:
         url = rec.get("url")
         if not url: continue
         key = normalize_url(url)
-        if key in unique:
-            unique[key] = choose_better_record(unique[key], rec)
-        else:
-            unique[key] = rec
-    return list(unique.values())
+        quality = record_quality(rec)
+        old = unique.get(key)
+        # 质量完全相同时保留先出现的记录
+        if old is None or quality > old[0]:
+            unique[key] = (quality, rec)
+    return unique
+
+def iter_file_records(file_path):
+    """
+    逐行流式读取一个批次文件中的记录。
+    文件以只读方式内存映射，直接在字节上查找换行，切片交给 orjson，不经过文本解码和 readline。
+    """
+    if os.path.getsize(file_path) > 0:
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start, size = 0, len(mm)
+            while start < size:
+                nl = mm.find(b"\n", start)
+                if nl < 0:
+                    nl = size
+                line = mm[start:nl]
+                start = nl + 1
+                if line:
+                    try:
+                        yield orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        continue
+
+def process_batch_file(file_path):
+    """在子进程中解析并去重一个批次文件，返回该文件的 {规范化URL: (质量元组, 最佳记录)}。"""
+    return deduplicate_records(iter_file_records(file_path))
+
+def merge_partial(unique, partial):
+    """把一个子进程的去重结果合并进 unique，规则与 deduplicate_records 相同。"""
+    for key, (quality, rec) in partial.items():
+        old = unique.get(key)
+        if old is None or quality > old[0]:
+            unique[key] = (quality, rec)
+
+
+def list_batch_paths():
+    """OUTPUT_DIR 中所有分页文件的路径。"""
+    if not os.path.isdir(OUTPUT_DIR):
+        return []
+    return [os.path.join(OUTPUT_DIR, fname) for fname in os.listdir(OUTPUT_DIR) if fname.endswith(".jsonl")]
+
+def list_folded_paths():
+    """已经并入 OUTPUT、移到 FOLDED_PAGES_DIR 的分页文件的路径。"""
+    if not os.path.isdir(FOLDED_PAGES_DIR):
+        return []
+    return [os.path.join(FOLDED_PAGES_DIR, fname) for fname in os.listdir(FOLDED_PAGES_DIR) if fname.endswith(".jsonl")]
+
+def fold_batch_files(paths):
+    """
+    分页文件已经并入 OUTPUT 后调用：先把对应任务记进完成日志（移走后扫描目录就找不到它们了），
+    再把文件移到 FOLDED_PAGES_DIR，下次运行不再重新解析。
+    """
+    task_ids = []
+    for path in paths:
+        filename = os.path.basename(path)
+        if filename.startswith("page_") and os.path.getsize(path) > 0:
+            task_ids.append(filename[5:-6])
+    if task_ids:
+        with open(COMPLETED_LOG_FILE, "a", encoding="utf-8") as f:
+            f.write("".join(task_id + "\n" for task_id in task_ids))
+    os.makedirs(FOLDED_PAGES_DIR, exist_ok=True)
+    for path in paths:
+        os.replace(path, os.path.join(FOLDED_PAGES_DIR, os.path.basename(path)))
+
+def load_unique(paths):
+    """
+    并行解析并去重若干 JSONL 文件，返回 {规范化URL: (质量元组, 最佳记录)}。
+    JSON 解析和 URL 规范化是纯 CPU 工作，按文件分给多个进程，主进程只做归并。
+    用 imap 按文件顺序归并，质量相同的记录之间的取舍与单进程时一致
+    """
+    unique = {}
+    with Pool(processes=NUM_PROCESSES) as pool:
+        results_iterator = pool.imap(process_batch_file, paths, chunksize=4)
+        for partial in tqdm(results_iterator, total=len(paths), desc="加载并去重批次文件"):
+            merge_partial(unique, partial)
+    return unique
+
+def write_merged(unique, path):
+    """写出去重结果。先写临时文件再替换，中途退出不会留下半个文件。"""
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        chunk = []
+        for _, rec in unique.values():
+            chunk.append(orjson.dumps(rec))
+            if len(chunk) >= WRITE_CHUNK_SIZE:
+                f.write(b"\n".join(chunk) + b"\n")
+                chunk = []
+        if chunk:
+            f.write(b"\n".join(chunk) + b"\n")
+    os.replace(tmp_path, path)
 
 
 def main_merge_and_deduplicate():
     print("\n===== 阶段 3: 合并与去重 =====")
 
-    all_records = []
     if not os.path.isdir(OUTPUT_DIR):
         print(f"输出目录 {OUTPUT_DIR} 不存在，无法合并。")
         return
         
-    batch_files = [f for f in os.listdir(OUTPUT_DIR) if f.endswith(".jsonl")]
-    if not batch_files:
+    batch_paths = list_batch_paths() + list_folded_paths()
+    if not batch_paths:
         print(f"在输出目录 '{OUTPUT_DIR}' 中没有找到任何 .jsonl 文件，无法合并。")
         return
 
-    for fname in tqdm(batch_files, desc="加载批次文件"):
-        file_path = os.path.join(OUTPUT_DIR, fname)
-        if os.path.getsize(file_path) > 0:
-            with open(file_path, "r", encoding="utf-8") as f:
-                for line in f:
-                    try:
-                        all_records.append(json.loads(line))
-                    except json.JSONDecodeError:
-                        continue
-
-    if not all_records:
+    unique = load_unique(batch_paths)
+    if not unique:
         print("没有加载到任何记录，程序结束。")
         return
-        
-    print(f"共加载 {len(all_records)} 条记录，正在去重...")
 
-    merged = deduplicate_records(all_records)
-    print(f"✅ 去重后剩余 {len(merged)} 条唯一记录")
+    print(f"✅ 去重后剩余 {len(unique)} 条唯一记录")
 
-    with open(OUTPUT, "w", encoding="utf-8") as f:
-        for rec in merged:
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    write_merged(unique, OUTPUT)
 
     print(f"\n✅ 已合并并保存到 {OUTPUT}")
     print("下一步：可使用正文下载脚本提取网页内容。")
@@ -267,6 +470,10 @@ if __name__ == "__main__":
     # 阶段二：执行下载循环
     download_successful = main_downloader()
     
-    # 阶段三：仅在下载成功后执行合并与去重
-    if download_successful:
-        main_merge_and_deduplicate()
\ No newline at end of file
+    # 阶段三：仅在下载成功后执行合并与去重；不保存分页文件时下载阶段已经写出了合并结果，
+    # 但合并结果被删掉时仍要从分页文件重建
+    if download_successful and (SAVE_RAW_PAGES or not os.path.exists(OUTPUT)):
+        main_merge_and_deduplicate()
+    elif download_successful:
+        print(f"\n✅ 合并结果已保存到 {OUTPUT}")
+        print("下一步：可使用正文下载脚本提取网页内容。")
\ No newline at end of file
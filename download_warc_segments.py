@@ -1,13 +1,35 @@
 # download_warc.py (v5 - 精确目录控制 & True Streaming)
 import os
-import json
+import orjson
+import sqlite3
 import hashlib
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
 import time
+import queue
+import random
 import threading
+import functools
+import itertools
 import concurrent.futures
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from tqdm import tqdm
 from requests.exceptions import RequestException, ChunkedEncodingError, ConnectionError, ReadTimeout
+import urllib3
+from urllib3 import exceptions as urllib3_exceptions
+from urllib3.util.retry import Retry
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 USE_T7 = False
 if USE_T7:
@@ -25,30 +47,198 @@ INPUT_JSONL = f"{database_prefix}/guardian_index_sample_1000.jsonl"
 OUTPUT_DIR = f"{database_prefix}/sample_1000"
 LOG_FILE = f"{database_prefix}/sample_1000/download_failed.log"
 SUCCESS_LOG = f"{database_prefix}/sample_1000/download_success.log"
+# 已完成记录存放在 SQLite 中（表 done，主键为文件名里哈希的原始字节），启动时一次顺序读出，
+# 不再逐行解析越来越大的文本日志。首次创建数据库时自动导入已有的 SUCCESS_LOG
+USE_DONE_DB = True
+DONE_DB = f"{database_prefix}/sample_1000/download_done.db"
 
 BASE_URL = "https://data.commoncrawl.org/"
 MAX_WORKERS = 128
 MAX_FILES_PER_DIR = 5000
+# 开启后不再按 batch_XXXX 顺序分目录，而是按文件名哈希的前 4 位放进 xx/yy/ 两级目录：
+# 不需要启动时扫描目录、也不需要加锁分配目录。
+# 注意 package_warc_batches.py 只打包 batch_XXXX 目录，开启前请确认后续流程
+NESTED_DIRS = False
 MAX_FUTURES_IN_FLIGHT = MAX_WORKERS * 4
+# 安装了 aiohttp 时改用 asyncio 下载：一个事件循环管理所有连接。
+# 协程不像线程那样占用栈内存，并发请求数可以比 MAX_WORKERS 高得多
+USE_ASYNC = aiohttp is not None
+ASYNC_CONCURRENCY = 512
+# 日志每攒够这么多条或每隔这么多秒才刷到磁盘一次
+LOG_FLUSH_EVERY = 500
+LOG_FLUSH_INTERVAL = 2
+# 旧版本用 md5 命名文件；开启后，成功日志里记录的 md5 文件名也算作已下载，避免重复下载
+CHECK_LEGACY_MD5_NAMES = True
+# 启动时再扫描一遍 batch_XXXX 目录，把已经存在的文件也算作已完成（成功日志丢失或未刷盘时有用）。
+# 外置硬盘上读目录元数据延迟高，用多个线程同时扫描不同的 batch 目录
+SCAN_EXISTING_FILES = True
+SCAN_WORKERS = 8
+# 每读入这么多条记录就按 (WARC 文件, 偏移) 排序后再提交，相邻的请求落在同一个 WARC 文件上。
+# 设为 None 时先把待下载的记录全部读进内存再整体排序（索引放得进内存时局部性最好，
+# 但要等整个索引读完才开始下载，进度条会先走到头）
+SORT_BUFFER_SIZE = 1000
+# 写 WARC 文件的缓冲区大小；文件只写一次不会再读，写完后提示内核不必留在页缓存里
+WRITE_BUFFER_SIZE = 1 << 20
+DROP_PAGE_CACHE = True
+# 服务器要求的 Retry-After 最多等待这么多秒
+MAX_RETRY_AFTER = 300
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# ========== 线程锁 (无变化) ==========
-fail_log_lock = threading.Lock()
-success_log_lock = threading.Lock()
+# 全局共享的 Session：所有线程复用到 data.commoncrawl.org 的 keep-alive 连接，
+# 不再每个 Range 请求都重新做一次 TCP+TLS 握手。连接池大小与线程数一致
+# 连接失败、响应头读取超时、429/5xx 由 urllib3 在连接池内重试，遵守服务器的 Retry-After，
+# 不必重新走一遍 fetch_segment；fetch_segment 自己的循环只处理响应体读到一半出错、长度不符等情况。
+# urllib3 2.x 起支持 backoff_jitter：退避时间加上随机抖动，被限流时各线程不会在同一时刻一起重试
+RETRY_JITTER = {"backoff_jitter": 2.0} if int(urllib3.__version__.split(".")[0]) >= 2 else {}
+HTTP_RETRY = Retry(
+    total=3, connect=3, read=3, status=3,
+    backoff_factor=2,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset({"GET"}),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+    **RETRY_JITTER,
+)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=MAX_WORKERS, max_retries=HTTP_RETRY))
+
+# ========== 线程锁 ==========
 # <<< 新增线程锁：用于控制 get_target_directory 的并发访问 >>>
 # 虽然 os.makedirs(exist_ok=True) 是线程安全的，但为了防止多个线程在同一瞬间
 # 都发现某个目录满了并尝试创建下一个目录，加锁可以保证目录序号的严格递增。
 # 这是一个更稳健的做法。
 dir_check_lock = threading.Lock()
+# 日志队列：下载线程/协程只管 put，每个队列由唯一的写线程落盘，不再为写日志抢锁
+fail_q = queue.Queue()
+success_q = queue.Queue()
+# 已启动的写线程：[(队列, 线程, 关闭函数)]，在 main() 中启动
+log_writers = []
+# 已完成记录数据库连接，在 main() 中打开，之后只在写线程里写入
+done_db = {}
+# 每个输出根目录当前使用的 batch 序号和已分配的文件数
+_dir_state = {}
 
 # ========== 工具函数 (get_target_directory 增加锁) ==========
 def safe_filename(url: str) -> str:
-    h = hashlib.md5(url.encode()).hexdigest()
+    # sha256 有 SHA-NI 硬件加速，比 md5 快；取前 16 位十六进制（64 bit）作为文件名已足够
+    h = hashlib.sha256(url.encode()).hexdigest()[:16]
     return f"{h}.warc.gz"
 
-def fetch_segment(record, retries=3, backoff=2):
-    # ... (此函数无变化) ...
+def filename_key(filename: str):
+    """
+    已完成集合里存文件名中十六进制哈希对应的整数，而不是文件名字符串本身：
+    64 位的 int 约 36 字节，24 个字符的 str 约 73 字节，千万级记录能省下一半内存。
+    文件名不是 "<十六进制>.warc.gz" 形式时返回 None。
+    """
+    try:
+        return int(filename[:filename.index(".")], 16)
+    except ValueError:
+        return None
+
+def load_success_log(path):
+    """
+    读取文本成功日志，返回 filename_key 集合。
+    整个文件一次读成 bytes、去掉后缀后按空白切分，再用 map(int, ..., 16) 在 C 层逐个解析，
+    每行不再经过一次 Python 函数调用；遇到格式不对的行才退回逐行的 filename_key。
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        return set(map(int, data.replace(b".warc.gz", b"").split(), itertools.repeat(16)))
+    except ValueError:
+        keys = {filename_key(line) for line in data.decode("utf-8", errors="ignore").split()}
+        keys.discard(None)
+        return keys
+
+def filename_blob(filename: str) -> bytes:
+    """文件名中十六进制哈希的原始字节，作为 done 表的主键；int.from_bytes(..., "big") 即 filename_key。"""
+    return bytes.fromhex(filename[:filename.index(".")])
+
+def url_name_and_key(url: str):
+    """
+    一次 sha256 同时得到文件名和它的 filename_key，过滤时不再对文件名切片、解析十六进制。
+    与 safe_filename(url)、filename_key(safe_filename(url)) 的结果相同。
+    """
+    digest = hashlib.sha256(url.encode()).digest()[:8]
+    return f"{digest.hex()}.warc.gz", int.from_bytes(digest, "big")
+
+def is_completed(url: str, key: int, completed_hashes) -> bool:
+    if key in completed_hashes:
+        return True
+    # 旧版本用 md5 的十六进制摘要作文件名，对应的 key 就是整个 md5 摘要
+    return CHECK_LEGACY_MD5_NAMES and int.from_bytes(hashlib.md5(url.encode()).digest(), "big") in completed_hashes
+
+def check_content_range(status_code, content_range, offset, end):
+    """
+    不看 Content-Length：部分 CDN 节点对 Range 响应用 chunked 传输，
+    Content-Length 缺失或含义不同，会导致好好的数据被当成失败重下。
+    只接受 206：服务器忽略 Range 返回 200 时响应体是整个 WARC 文件（可达数 GB），
+    必须在读响应体之前就判为失败。206 时以 Content-Range 确认返回的区间，
+    最终以实际读到的字节数为准（见 check_size）
+    """
+    if status_code != 206:
+        raise RequestException(f"Range request not honored. Expected status 206, got {status_code}")
+    if not content_range.startswith(f"bytes {offset}-{end}/"):
+        raise RequestException(f"Unexpected Content-Range. Expected bytes {offset}-{end}, got '{content_range}'")
+
+def check_size(received, length):
+    if received != length:
+        raise RequestException(f"Incomplete download. Expected {length} bytes, got {received}")
+
+def retry_after_delay(headers, default):
+    """
+    服务器在 429/503 等响应里给出 Retry-After 时按它的要求等待（秒数或 HTTP 日期），
+    否则使用默认的退避时间。
+    """
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return default
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return default
+    return min(max(delay, 0), MAX_RETRY_AFTER)
+
+def backoff_delay(backoff, attempt):
+    """完全随机的指数退避（full jitter）：所有线程同时失败时，下一次重试也会被打散。"""
+    return random.uniform(0, backoff * (2 ** attempt))
+
+def disable_page_cache(fd):
+    """macOS 上没有 posix_fadvise，用 F_NOCACHE 在写之前关闭这个文件的缓存。"""
+    if DROP_PAGE_CACHE and fcntl is not None and hasattr(fcntl, "F_NOCACHE"):
+        fcntl.fcntl(fd, fcntl.F_NOCACHE, 1)
+
+def drop_page_cache(fd):
+    """Linux 上写完后用 POSIX_FADV_DONTNEED 释放这个文件占用的页缓存。"""
+    if DROP_PAGE_CACHE and hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+def write_all(fd, data):
+    """把 data（bytes 或 memoryview）完整写入 fd，os.write 可能只写入一部分。"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+# 每个下载线程各自持有一块读缓冲区，第一次用到时才分配，之后所有记录、所有重试都复用它
+_thread_local = threading.local()
+
+def get_read_buffer():
+    buf = getattr(_thread_local, "read_buffer", None)
+    if buf is None:
+        buf = _thread_local.read_buffer = memoryview(bytearray(WRITE_BUFFER_SIZE))
+    return buf
+
+def fetch_segment(record, output_path, retries=3, backoff=2):
+    """
+    下载一条记录对应的 WARC 片段，直接从 socket 流式写入 output_path，
+    每个线程只占用一块复用的读缓冲区，不再把整段内容读进内存。
+    先写到 .part 临时文件，校验通过后再改名，失败时不会在 batch 目录里留下残缺文件。
+    """
+    tmp_path = output_path + ".part"
     warc_path = record["filename"]
     offset = int(record["offset"])
     length = int(record["length"])
@@ -57,62 +247,216 @@ def fetch_segment(record, retries=3, backoff=2):
     headers = {"Range": f"bytes={offset}-{end}"}
     for attempt in range(retries):
         try:
-            with requests.get(warc_url, headers=headers, timeout=(10, 60), stream=True) as resp:
+            with SESSION.get(warc_url, headers=headers, timeout=(10, 60), stream=True) as resp:
                 resp.raise_for_status()
-                content_length = int(resp.headers.get('Content-Length', 0))
-                if content_length != length:
-                     raise RequestException(f"Incomplete download. Expected {length} bytes, got {content_length}")
-                return resp.content
-        except (ChunkedEncodingError, ConnectionError, ReadTimeout, RequestException) as e:
-            if attempt < retries - 1:
-                time.sleep(backoff * (2 ** attempt))
+                check_content_range(resp.status_code, resp.headers.get("Content-Range", ""), offset, end)
+                # WARC 片段本身就是 gzip 数据，原样写盘，不做解码
+                resp.raw.decode_content = False
+                # readinto 读进本线程复用的缓冲区，os.write 直接写 fd：
+                # 每块数据不再新建 bytes 对象，也不再经过 Python 写缓冲多拷贝一次
+                buf = get_read_buffer()
+                received = 0
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    disable_page_cache(fd)
+                    while True:
+                        n = resp.raw.readinto(buf)
+                        if not n:
+                            break
+                        write_all(fd, buf[:n])
+                        received += n
+                    drop_page_cache(fd)
+                finally:
+                    os.close(fd)
+                check_size(received, length)
+            os.replace(tmp_path, output_path)
+            return
+        except (ChunkedEncodingError, ConnectionError, ReadTimeout, RequestException, urllib3_exceptions.HTTPError) as e:
+            # HTTP 错误状态、连接失败、响应头超时已经由 HTTP_RETRY 重试过，不再重复
+            retried_by_adapter = isinstance(e, (requests.exceptions.HTTPError, ConnectionError, ReadTimeout))
+            if attempt < retries - 1 and not retried_by_adapter:
+                time.sleep(backoff_delay(backoff, attempt))
             else:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
                 raise e
 
+async def fetch_segment_async(session, sem, record, retries=3, backoff=2):
+    """fetch_segment 的 asyncio 版本。重试等待期间不占用并发名额。"""
+    warc_path = record["filename"]
+    offset = int(record["offset"])
+    length = int(record["length"])
+    end = offset + length - 1
+    warc_url = BASE_URL + warc_path
+    headers = {"Range": f"bytes={offset}-{end}"}
+    for attempt in range(retries):
+        try:
+            async with sem, session.get(warc_url, headers=headers) as resp:
+                resp.raise_for_status()
+                check_content_range(resp.status, resp.headers.get("Content-Range", ""), offset, end)
+                # 单条记录通常只有几十 KB，整段读入后交给线程池写盘
+                body = await resp.read()
+                check_size(len(body), length)
+                return body
+        except (aiohttp.ClientError, asyncio.TimeoutError, RequestException) as e:
+            if attempt < retries - 1:
+                # aiohttp 没有连接池内的自动重试，429/503 在这里按 Retry-After 等待
+                limited = isinstance(e, aiohttp.ClientResponseError) and e.status in (429, 503)
+                await asyncio.sleep(retry_after_delay(e.headers if limited else None, backoff_delay(backoff, attempt)))
+            else:
+                raise
+
+
+def log_writer(q, write, flush):
+    """
+    单写线程：从队列取出记录写入，每 LOG_FLUSH_EVERY 条或每 LOG_FLUSH_INTERVAL 秒才刷盘一次，
+    队列空闲时也会把已写入的记录刷下去。收到 None 后刷盘并退出。
+    异常退出时最多丢失最近一小批成功记录，下次运行只会重新下载这些文件。
+    """
+    pending, ts = 0, time.monotonic()
+    while True:
+        try:
+            item = q.get(timeout=LOG_FLUSH_INTERVAL)
+        except queue.Empty:
+            item = ""
+        if item is None:
+            break
+        if item:
+            write(item)
+            pending += 1
+        if pending and (pending >= LOG_FLUSH_EVERY or time.monotonic() - ts >= LOG_FLUSH_INTERVAL):
+            flush()
+            pending, ts = 0, time.monotonic()
+    flush()
+
+def open_text_sink(path):
+    """
+    文本日志先攒在内存里，刷盘时拼成一块用 os.write 一次写入再 fsync。
+    以 O_APPEND 打开，每次写入都原子地追加到文件末尾，不需要 seek，也不经过 Python 的文件缓冲。
+    第一次刷盘时才打开文件，没有失败记录就不会生成空的失败日志。
+    """
+    buf = []
+    fds = []
+    def flush():
+        if buf:
+            if not fds:
+                fds.append(os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644))
+            write_all(fds[0], "".join(buf).encode("utf-8"))
+            buf.clear()
+        for fd in fds:
+            os.fsync(fd)
+    def close():
+        for fd in fds:
+            os.close(fd)
+    return buf.append, flush, close
+
+def open_db_sink():
+    conn = done_db["conn"]
+    def write(filename):
+        conn.execute("INSERT OR IGNORE INTO done VALUES (?)", (filename_blob(filename),))
+    # 连接由 close_logs() 统一关闭（输入文件缺失时写线程根本不会启动）
+    return write, conn.commit, lambda: None
+
+def start_log_writers():
+    """为失败日志和成功记录（文本日志或数据库）各启动一个写线程。"""
+    sinks = [(fail_q, open_text_sink(LOG_FILE))]
+    sinks.append((success_q, open_db_sink() if done_db else open_text_sink(SUCCESS_LOG)))
+    for q, (write, flush, close) in sinks:
+        t = threading.Thread(target=log_writer, args=(q, write, flush), daemon=True)
+        t.start()
+        log_writers.append((q, t, close))
+
+def open_done_db():
+    """打开（必要时创建）已完成记录数据库，返回其中所有记录的 filename_key 集合。"""
+    is_new = not os.path.exists(DONE_DB)
+    conn = sqlite3.connect(DONE_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS done (hash BLOB PRIMARY KEY) WITHOUT ROWID")
+    if is_new and os.path.exists(SUCCESS_LOG):
+        print(f"首次使用数据库，正在导入 '{SUCCESS_LOG}'...")
+        with open(SUCCESS_LOG, "r", encoding="utf-8") as f:
+            blobs = []
+            for line in f:
+                try:
+                    blobs.append((filename_blob(line.strip()),))
+                except ValueError:
+                    continue
+        conn.executemany("INSERT OR IGNORE INTO done VALUES (?)", blobs)
+    conn.commit()
+    done_db["conn"] = conn
+    return {int.from_bytes(h, "big") for (h,) in conn.execute("SELECT hash FROM done")}
+
+def close_logs():
+    """给每个写线程发结束标记，等它们把队列里剩下的记录写完并刷盘后关闭文件和数据库。"""
+    for q, t, close in log_writers:
+        q.put(None)
+        t.join()
+        close()
+    log_writers.clear()
+    if done_db:
+        done_db["conn"].close()
+        done_db.clear()
 
 def log_failure(url, reason):
-    with fail_log_lock:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(f"{url}\t{reason}\n")
+    fail_q.put(f"{url}\t{reason}\n")
 
 def log_success(filename_hash: str):
-    with success_log_lock:
-        with open(SUCCESS_LOG, "a", encoding="utf-8") as f:
-            f.write(f"{filename_hash}\n")
+    success_q.put(filename_hash if done_db else f"{filename_hash}\n")
 
 def get_target_directory(base_dir: str) -> str:
     """
     获取当前应该用于保存文件的目录。
-    这个函数现在是线程安全的，并且每次调用都会检查最新的目录状态。
+    线程安全。只在第一次调用时扫描磁盘确定最新的 batch 目录及其文件数，
+    之后在内存中计数，不再每条记录都 listdir 两次。
     """
     with dir_check_lock: # <<< 修改：增加锁来保证操作的原子性
-        try:
-            subdirs = [d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d)) and d.startswith("batch_")]
-        except FileNotFoundError:
-            subdirs = []
-
-        if not subdirs:
-            target_dir = os.path.join(base_dir, "batch_0000")
-        else:
-            latest_dir_name = sorted(subdirs)[-1]
-            latest_dir_path = os.path.join(base_dir, latest_dir_name)
+        state = _dir_state.get(base_dir)
+        if state is None:
+            # os.scandir 的 DirEntry 自带文件类型，判断目录不需要再 stat 一次
             try:
-                # 统计实际文件数，排除隐藏文件
-                num_files = len([f for f in os.listdir(latest_dir_path) if not f.startswith('.')])
+                with os.scandir(base_dir) as it:
+                    subdirs = [e.name for e in it if e.name.startswith("batch_") and e.is_dir(follow_symlinks=False)]
             except FileNotFoundError:
-                num_files = 0
+                subdirs = []
 
-            if num_files >= MAX_FILES_PER_DIR:
-                latest_batch_num = int(latest_dir_name.split('_')[-1])
-                new_batch_num = latest_batch_num + 1
-                target_dir = os.path.join(base_dir, f"batch_{new_batch_num:04d}")
+            if not subdirs:
+                state = {"batch_num": 0, "count": 0}
             else:
-                target_dir = latest_dir_path
-
+                latest_dir_name = sorted(subdirs)[-1]
+                latest_dir_path = os.path.join(base_dir, latest_dir_name)
+                try:
+                    # 统计实际文件数，排除隐藏文件
+                    with os.scandir(latest_dir_path) as it:
+                        num_files = sum(1 for e in it if not e.name.startswith('.'))
+                except FileNotFoundError:
+                    num_files = 0
+                state = {"batch_num": int(latest_dir_name.split('_')[-1]), "count": num_files}
+            _dir_state[base_dir] = state
+
+        if state["count"] >= MAX_FILES_PER_DIR:
+            state["batch_num"] += 1
+            state["count"] = 0
+
+        # 按分配次数计数：下载失败的记录也占一个名额，目录可能略少于上限，但绝不会超出
+        state["count"] += 1
+        target_dir = os.path.join(base_dir, f"batch_{state['batch_num']:04d}")
         os.makedirs(target_dir, exist_ok=True)
         return target_dir
 
 
+@functools.lru_cache(maxsize=None)
+def ensure_dir(dir_path: str) -> str:
+    """每个目录只 makedirs 一次。"""
+    os.makedirs(dir_path, exist_ok=True)
+    return dir_path
+
+def get_output_path(base_dir: str, filename: str) -> str:
+    if NESTED_DIRS:
+        return os.path.join(ensure_dir(os.path.join(base_dir, filename[:2], filename[2:4])), filename)
+    return os.path.join(get_target_directory(base_dir), filename)
+
+
 # ========== 主逻辑 (核心修改) ==========
 
 # <<< 核心修改 1：修改 process_record 函数 >>>
@@ -121,17 +465,13 @@ def process_record(record, base_output_dir):
     处理单个记录，函数内部动态决定存储目录。
     """
     url = record["url"]
-    filename = safe_filename(url)
+    filename = record["_fn"]
     
     # 在保存文件前，动态获取当前正确的目标目录
-    target_dir = get_target_directory(base_output_dir)
-    
-    output_path = os.path.join(target_dir, filename)
+    output_path = get_output_path(base_output_dir, filename)
 
     try:
-        warc_bytes = fetch_segment(record)
-        with open(output_path, "wb") as f:
-            f.write(warc_bytes)
+        fetch_segment(record, output_path)
         log_success(filename)
         return ("success", url, None)
     except Exception as e:
@@ -139,18 +479,122 @@ def process_record(record, base_output_dir):
         log_failure(url, error_message)
         return ("failed", url, error_message)
 
-def generate_tasks(input_file, completed_hashes):
-    # ... (此函数无变化) ...
+def save_segment(output_path, warc_bytes, filename):
+    # 同样先写临时文件再改名，batch 目录里的 .warc.gz 一定是完整的。
+    # 整段数据已在内存中，直接 os.write 写入，不经过 Python 的写缓冲多拷贝一次
+    tmp_path = output_path + ".part"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        disable_page_cache(fd)
+        write_all(fd, warc_bytes)
+        drop_page_cache(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, output_path)
+    log_success(filename)
+
+async def process_record_async(session, sem, record, base_output_dir):
+    """process_record 的 asyncio 版本，写文件和日志交给线程池，不阻塞事件循环。"""
+    url = record["url"]
+    filename = record["_fn"]
+    output_path = get_output_path(base_output_dir, filename)
+
     try:
-        with open(input_file, "r", encoding="utf-8") as f:
+        warc_bytes = await fetch_segment_async(session, sem, record)
+        await asyncio.get_running_loop().run_in_executor(None, save_segment, output_path, warc_bytes, filename)
+        return ("success", url, None)
+    except Exception as e:
+        error_message = f"{type(e).__name__}: {str(e)}"
+        log_failure(url, error_message)
+        return ("failed", url, error_message)
+
+async def download_all_async(task_generator, handle_result):
+    """
+    用一个共享的 aiohttp ClientSession 下载所有记录。
+    最多同时进行 ASYNC_CONCURRENCY 个请求、挂起 ASYNC_CONCURRENCY * 2 个任务，避免把整个索引文件读进内存。
+    """
+    # 所有请求都发往同一个主机，DNS 结果缓存 10 分钟
+    connector = aiohttp.TCPConnector(limit=ASYNC_CONCURRENCY, limit_per_host=ASYNC_CONCURRENCY, keepalive_timeout=75, ttl_dns_cache=600)
+    timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=60)
+    sem = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    max_pending = ASYNC_CONCURRENCY * 2
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        pending = set()
+        for record in task_generator:
+            if len(pending) >= max_pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    handle_result(task)
+            pending.add(asyncio.ensure_future(process_record_async(session, sem, record, OUTPUT_DIR)))
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                handle_result(task)
+
+def scan_batch_dir(dir_path):
+    with os.scandir(dir_path) as it:
+        return [e.name for e in it if e.name.endswith(".warc.gz")]
+
+def scan_existing_files(base_dir):
+    """并发扫描 base_dir 下所有 batch_XXXX 目录，返回已存在文件的 filename_key 集合。"""
+    try:
+        with os.scandir(base_dir) as it:
+            batch_dirs = [e.path for e in it if e.name.startswith("batch_") and e.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return set()
+    existing = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        for names in executor.map(scan_batch_dir, batch_dirs):
+            existing.update(map(filename_key, names))
+    existing.discard(None)
+    return existing
+
+def sort_by_warc(records, buffer_size):
+    """
+    按 (filename, offset) 对每 buffer_size 条记录排序后依次产出；buffer_size 为 None 时整体排序。
+    同一个 WARC 文件的请求挨在一起发出，服务端读取更连续，也更容易复用同一条连接。
+    CommonCrawl 的存储不支持一次请求多个 Range（multipart/byteranges），所以仍是一条记录一个请求。
+    """
+    def warc_position(rec):
+        try:
+            return rec.get("filename", ""), int(rec.get("offset") or 0)
+        except (ValueError, TypeError):
+            # 格式不对的记录照常提交，由下载函数记录失败
+            return rec.get("filename", ""), 0
+
+    buffer = []
+    for rec in records:
+        buffer.append(rec)
+        if buffer_size and len(buffer) >= buffer_size:
+            buffer.sort(key=warc_position)
+            yield from buffer
+            buffer = []
+    buffer.sort(key=warc_position)
+    yield from buffer
+
+def generate_tasks(input_file, completed_hashes, progress_bar, stats):
+    """
+    流式读取索引文件，逐条产出需要下载的记录。
+    不再预先扫描一遍文件计算任务总数：进度条按已读取的字节数推进，
+    统计数据（总记录数、跳过数）在读取过程中累加到 stats。
+    """
+    try:
+        with open(input_file, "rb") as f:
             for line in f:
+                progress_bar.update(len(line))
+                stats["total"] += 1
                 try:
-                    record = json.loads(line)
-                    filename = safe_filename(record["url"])
-                    if filename in completed_hashes:
+                    record = orjson.loads(line)
+                    url = record["url"]
+                    # 文件名只在这里算一次，随记录传给下载函数
+                    filename, key = url_name_and_key(url)
+                    if is_completed(url, key, completed_hashes):
+                        stats["skipped"] += 1
                         continue
+                    record["_fn"] = filename
                     yield record
-                except (json.JSONDecodeError, KeyError):
+                except (orjson.JSONDecodeError, KeyError):
                     continue
     except FileNotFoundError:
         print(f"错误: 输入文件 '{input_file}' 未找到。")
@@ -161,95 +605,107 @@ def main():
     # --- 1. 加载已完成记录 (无变化) ---
     print("正在加载已完成的下载记录...")
     completed_hashes = set()
-    try:
-        with open(SUCCESS_LOG, "r", encoding="utf-8") as f:
-            completed_hashes.update(line.strip() for line in f)
-        print(f"从 '{SUCCESS_LOG}' 加载了 {len(completed_hashes)} 条记录。")
-    except FileNotFoundError:
-        print(f"成功日志 '{SUCCESS_LOG}' 未找到，将自动创建。")
-
-    # --- 2. 预先计算总任务数 (无变化) ---
-    print("正在扫描索引文件以计算任务总数...")
-    total_records_in_file = 0
-    total_to_download = 0
-    try:
-        with open(INPUT_JSONL, "r", encoding="utf-8") as f:
-            for line in f:
-                total_records_in_file += 1
-                try:
-                    url = json.loads(line).get("url")
-                    if url and safe_filename(url) not in completed_hashes:
-                        total_to_download += 1
-                except (json.JSONDecodeError, KeyError):
-                    continue
-    except FileNotFoundError:
+    if USE_DONE_DB:
+        completed_hashes = open_done_db()
+        print(f"从 '{DONE_DB}' 加载了 {len(completed_hashes)} 条记录。")
+    else:
+        try:
+            completed_hashes = load_success_log(SUCCESS_LOG)
+            print(f"从 '{SUCCESS_LOG}' 加载了 {len(completed_hashes)} 条记录。")
+        except FileNotFoundError:
+            print(f"成功日志 '{SUCCESS_LOG}' 未找到，将自动创建。")
+
+    # 扫描只针对 batch_XXXX 布局；两级目录布局下有多达 65536 个目录，只依赖已完成记录
+    if SCAN_EXISTING_FILES and not NESTED_DIRS:
+        print(f"正在扫描 '{OUTPUT_DIR}' 下已存在的文件...")
+        existing = scan_existing_files(OUTPUT_DIR)
+        missing_from_log = len(existing - completed_hashes)
+        completed_hashes |= existing
+        print(f"扫描到 {len(existing)} 个文件，其中 {missing_from_log} 个不在成功日志中。")
+
+    # --- 2. 检查输入文件 ---
+    # 不再为了计算任务总数预先完整读一遍索引文件，进度按读取的字节数显示
+    if not os.path.exists(INPUT_JSONL):
         print(f"错误: 输入文件 '{INPUT_JSONL}' 未找到。程序即将退出。")
         return
-
-    print(f"索引文件 '{INPUT_JSONL}' 中共有 {total_records_in_file} 条记录。")
     print(f"已完成: {len(completed_hashes)} 条。")
-    print(f"预计需要下载: {total_to_download} 个新文件。")
-
-    if total_to_download == 0:
-        print("\n所有文件均已下载，无需执行任何操作。")
-        return
+    start_log_writers()
 
     # --- 3. 流式处理和并发提交 (核心修改) ---
     # <<< 核心修改 2：不再预先获取 target_dir >>>
     # target_dir = get_target_directory(OUTPUT_DIR) # <--- 删除这一行
-    print(f"使用 {MAX_WORKERS} 个线程开始并发下载...")
-    print(f"文件将被自动下载到 '{OUTPUT_DIR}' 下的 batch_XXXX 目录中。")
+    if USE_ASYNC:
+        print(f"使用 asyncio 开始并发下载（最多 {ASYNC_CONCURRENCY} 个并发请求）...")
+    else:
+        print(f"使用 {MAX_WORKERS} 个线程开始并发下载...")
+    if NESTED_DIRS:
+        print(f"文件将按哈希前缀下载到 '{OUTPUT_DIR}' 下的 xx/yy/ 两级目录中。")
+    else:
+        print(f"文件将被自动下载到 '{OUTPUT_DIR}' 下的 batch_XXXX 目录中。")
 
     success_count = 0
     failed_count = 0
+    stats = {"total": 0, "skipped": 0}
+    # 进度条最多每 0.5 秒刷新一次，避免上百个并发任务每完成一个就重绘一次终端
+    progress_bar = tqdm(total=os.path.getsize(INPUT_JSONL), unit="B", unit_scale=True, desc="下载进度", mininterval=0.5)
+    last_postfix = 0.0
     
-    task_generator = generate_tasks(INPUT_JSONL, completed_hashes)
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = []
-        progress_bar = tqdm(total=total_to_download, desc="下载进度")
+    task_generator = sort_by_warc(generate_tasks(INPUT_JSONL, completed_hashes, progress_bar, stats), SORT_BUFFER_SIZE)
 
-        for record in task_generator:
-            if len(futures) >= MAX_FUTURES_IN_FLIGHT:
-                done_future = next(concurrent.futures.as_completed(futures))
-                futures.remove(done_future)
-                
-                try:
-                    status, _, _ = done_future.result()
-                    if status == "success": success_count += 1
-                    else: failed_count += 1
-                except Exception as e:
-                    log_failure("unknown_url", f"executor_error: {e}")
-                    failed_count += 1
-                finally:
-                    progress_bar.update(1)
-                    progress_bar.set_postfix(success=success_count, failed=failed_count)
+    # 线程池模式下 handle_result 在工作线程的完成回调里执行，计数需要加锁
+    result_lock = threading.Lock()
 
-            # <<< 核心修改 3：提交任务时，传递基础输出目录 OUTPUT_DIR >>>
-            # 而不是之前固定的 target_dir
-            future = executor.submit(process_record, record, OUTPUT_DIR)
-            futures.append(future)
+    def handle_result(done_future):
+        """统计一个已完成任务的结果，线程池的 Future 和 asyncio 的 Task 都适用。"""
+        nonlocal success_count, failed_count, last_postfix
+        try:
+            status, _, _ = done_future.result()
+            ok = status == "success"
+        except Exception as e:
+            log_failure("unknown_url", f"executor_error: {e}")
+            ok = False
+        with result_lock:
+            if ok: success_count += 1
+            else: failed_count += 1
+            # 计数随时更新，显示的 postfix 每 0.5 秒才格式化一次
+            now = time.monotonic()
+            if now - last_postfix >= 0.5:
+                progress_bar.set_postfix(success=success_count, failed=failed_count)
+                last_postfix = now
 
-        # --- 4. 处理剩余的 future (无变化) ---
-        progress_bar.set_description("下载收尾")
-        for future in concurrent.futures.as_completed(futures):
+    if USE_ASYNC:
+        asyncio.run(download_all_async(task_generator, handle_result))
+        progress_bar.set_postfix(success=success_count, failed=failed_count)
+        progress_bar.close()
+    else:
+        # 信号量限制同时挂起的任务数：提交前 acquire，任务完成的回调里 release。
+        # 不需要保存 future 列表，也不用在提交循环里等待、查找已完成的 future
+        in_flight = threading.Semaphore(MAX_FUTURES_IN_FLIGHT)
+
+        def on_done(future):
             try:
-                status, _, _ = future.result()
-                if status == "success": success_count += 1
-                else: failed_count += 1
-            except Exception as e:
-                log_failure("unknown_url", f"executor_error: {e}")
-                failed_count += 1
+                handle_result(future)
             finally:
-                progress_bar.update(1)
-                progress_bar.set_postfix(success=success_count, failed=failed_count)
-        
+                in_flight.release()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for record in task_generator:
+                in_flight.acquire()
+                # <<< 核心修改 3：提交任务时，传递基础输出目录 OUTPUT_DIR >>>
+                # 而不是之前固定的 target_dir
+                executor.submit(process_record, record, OUTPUT_DIR).add_done_callback(on_done)
+
+            # --- 4. 退出 with 时等待剩余任务完成 ---
+            progress_bar.set_description("下载收尾")
+
+        progress_bar.set_postfix(success=success_count, failed=failed_count)
         progress_bar.close()
 
     print("\n✅ 下载完成！")
     print("========== 结果统计 ==========")
     print(f"  本次成功下载: {success_count}")
-    print(f"  已跳过 (之前已下载): {total_records_in_file - total_to_download}")
+    print(f"  索引文件中的记录总数: {stats['total']}")
+    print(f"  已跳过 (之前已下载): {stats['skipped']}")
     print(f"  下载失败: {failed_count}")
     if failed_count > 0:
         print(f"  失败详情请查看日志文件: '{LOG_FILE}'")
@@ -257,4 +713,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        main()
+    finally:
+        close_logs()
\ No newline at end of file
@@ -3,12 +3,43 @@ import os
 import re
 import io
 import gzip
-import json
+import mmap
+from contextlib import contextmanager
+import orjson
 import glob
+import hashlib
 from tqdm import tqdm
 from charset_normalizer import from_bytes
+# 安装了 cchardet（faust-cchardet）时用它探测编码，比 charset_normalizer 快得多
+try:
+    import cchardet
+except ImportError:
+    cchardet = None
 from bs4 import BeautifulSoup
-from typing import Dict, Optional, Tuple, List
+# selectolax 1.0 起只保留 Lexbor 后端，旧版本用 parser 模块
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser
+    except ImportError:
+        HTMLParser = None
+# 安装了 isal（Intel ISA-L 的 Python 绑定）时用它的 SIMD 实现解压 gzip，接口和异常与 gzip 模块一致
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+# 安装了 deflate（libdeflate 的 Python 绑定）时优先用它整块解压，单个 gzip 成员时比 ISA-L 还快
+try:
+    import deflate
+except ImportError:
+    deflate = None
+# 安装了 pyroaring 时用 64 位 Roaring 位图保存已处理 ID 的哈希，比 Python 集合省得多的内存
+try:
+    from pyroaring import BitMap64
+except ImportError:
+    BitMap64 = None
+from typing import Dict, Optional, Tuple, List, Union
 from multiprocessing import Pool, cpu_count
 
 # ========== 配置 ==========
@@ -21,8 +52,26 @@ OUTPUT_DATA_DIR = "sample_1000_featured"  # 输出目录名更改，更符合内
 LOG_FILE = "extraction_failed.log"
 
 FILES_PER_CHUNK = 10000
+# 输出数据块文件的写缓冲：记录已在子进程序列化成 bytes，攒满这么多再交给系统写一次
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024  # 8MB
 # 使用所有可用的CPU核心数减一，留一个给系统，或者直接用 cpu_count()
 NUM_PROCESSES = max(1, cpu_count() - 1) 
+# 每次给子进程派发这么多个文件，减少单个小文件任务的进程间通信开销
+POOL_CHUNKSIZE = 32
+# 探测编码时（cchardet 或 charset_normalizer）只看响应体的前这么多字节，超大页面不会拖慢探测
+CHARSET_SNIFF_BYTES = 65536
+# 不小于这个大小的输入文件用 mmap 映射后直接解压，不再先整份读进内存
+MMAP_MIN_BYTES = 8 * 1024 * 1024
+# 安装了 selectolax 时用它解析 HTML（C 实现），比 BeautifulSoup 快一个数量级；
+# 否则退回 BeautifulSoup + lxml，两者提取出的字段相同
+USE_SELECTOLAX = HTMLParser is not None
+
+# 正文容器 div[itemprop="articleBody"] / div[class*="content__article-body"] 的特征字符串，
+# 解析前先做子串检查，两者都不存在的页面不再解析
+ARTICLE_BODY_MARKERS = ("articleBody", "content__article-body")
+
+# libdeflate 处理不了时使用的 gzip 解压函数：优先用 ISA-L
+_gzip_decompress = igzip.decompress if igzip is not None else gzip.decompress
 
 # 创建输出目录
 os.makedirs(OUTPUT_DATA_DIR, exist_ok=True)
@@ -30,36 +79,232 @@ os.makedirs(OUTPUT_DATA_DIR, exist_ok=True)
 
 # ========== 解析函数 (将在子进程中运行) ==========
 
+# 正则在模块加载时编译一次，不在每个文件、每次查找时重新查缓存
+_CHARSET_RE = re.compile(br"charset=([\w\-]+)", re.IGNORECASE)
+# extract_article_data_bs4 按 class 查找标签时用的正则
+_CLASS_RE = {name: re.compile(name) for name in (
+    'content__headline',
+    'content__article-body',
+    'signposting',
+    'signposting__item',
+    'subnav__list',
+    'subnav__item',
+    'subnav-link',
+    'content__labels',
+    'content__section-label__link',
+    'submeta__keywords',
+    'submeta__link',
+    'keyword-list',
+    'submeta__links',
+)}
+
+@contextmanager
+def open_warc_bytes(path: str):
+    """
+    读入整个 WARC 文件供解压。小文件用 os.open/os.read 读成 bytes，省掉 open() 为每个小文件创建
+    BufferedReader 的开销；按 fstat 得到的大小多请求 1 字节，一次返回不足即已到文件末尾。
+    不小于 MMAP_MIN_BYTES 的文件改为只读 mmap，以 memoryview 交给解压函数，
+    压缩数据不再整份复制到进程内存里，由系统按需换入页面。
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size >= MMAP_MIN_BYTES:
+            # mmap 内部会复制一份文件描述符，这里的 fd 可以照常关闭
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        else:
+            mm = None
+            data = os.read(fd, size + 1)
+            if len(data) > size:
+                # 读取期间文件变大，或单次 read 有上限时，读到末尾为止
+                parts = [data]
+                while True:
+                    chunk = os.read(fd, 1 << 20)
+                    if not chunk:
+                        break
+                    parts.append(chunk)
+                data = b"".join(parts)
+    finally:
+        os.close(fd)
+
+    if mm is None:
+        yield data
+        return
+    with mm:
+        view = memoryview(mm)
+        try:
+            yield view
+        finally:
+            view.release()
+
+def gzip_decompress(data: bytes) -> bytes:
+    """
+    优先用 libdeflate 解压。它只解第一个 gzip 成员，输出缓冲区按最后 4 字节（最后一个成员的 ISIZE）分配：
+    多成员数据不一定报错，可能只返回第一个成员。所以只有解出的长度与 ISIZE 一致时才采用它的结果，
+    否则（多个成员、不是 gzip 数据等）交给 ISA-L / zlib 再解一次，异常也由它们按 gzip 模块的约定抛出。
+    """
+    if deflate is not None:
+        try:
+            out = deflate.gzip_decompress(data)
+            if len(out) & 0xFFFFFFFF == int.from_bytes(data[-4:], "little"):
+                return out
+        except (deflate.DeflateError, ValueError):
+            pass
+    return _gzip_decompress(data)
+
 def extract_html_from_warc(warc_bytes: bytes) -> str:
     # ... (此函数无需更改)
     try:
-        raw_bytes = gzip.decompress(warc_bytes)
+        raw_bytes = gzip_decompress(warc_bytes)
     except (OSError, gzip.BadGzipFile):
-        raw_bytes = warc_bytes
+        # 输入是 mmap 的 memoryview 时复制成 bytes；本来就是 bytes 时 bytes() 不会复制
+        raw_bytes = bytes(warc_bytes)
         
     header_end = raw_bytes.find(b'\r\n\r\n')
     if header_end == -1: return raw_bytes.decode('utf-8', errors='ignore')
     http_header_end = raw_bytes.find(b'\r\n\r\n', header_end + 4)
     if http_header_end == -1: return raw_bytes.decode('utf-8', errors='ignore')
     
-    http_headers_bytes = raw_bytes[header_end+4:http_header_end]
-    body_bytes = raw_bytes[http_header_end+4:]
+    # HTTP 头直接在原缓冲区的区间内查找 charset，响应体用 memoryview 切片，解码前都不复制
+    match = _CHARSET_RE.search(raw_bytes, header_end+4, http_header_end)
+    body = memoryview(raw_bytes)[http_header_end+4:]
 
-    match = re.search(br"charset=([\w\-]+)", http_headers_bytes, re.IGNORECASE)
     if match:
         try:
             encoding = match.group(1).decode('ascii')
-            return body_bytes.decode(encoding, errors='ignore')
+            return str(body, encoding, 'ignore')
         except (LookupError, UnicodeDecodeError): pass
 
-    result = from_bytes(body_bytes).best()
-    return str(result) if result else body_bytes.decode('utf-8', errors='ignore')
+    # 绝大多数页面是 UTF-8：能严格按 UTF-8 解码就不再做代价很高的编码探测
+    try:
+        return str(body, 'utf-8')
+    except UnicodeDecodeError: pass
+
+    # 只取前 CHARSET_SNIFF_BYTES 字节做探测，并截在最后一个换行处，避免把多字节字符切成两半
+    sample = bytes(body[:CHARSET_SNIFF_BYTES])
+    if len(body) > CHARSET_SNIFF_BYTES:
+        cut = sample.rfind(b'\n')
+        if cut > 0:
+            sample = sample[:cut + 1]
+
+    if cchardet is not None:
+        encoding = cchardet.detect(sample)['encoding'] or 'utf-8'
+        try:
+            return str(body, encoding, 'ignore')
+        except LookupError:
+            return str(body, 'utf-8', 'ignore')
+
+    # 探测结果只用来确定编码，再用它解码完整的响应体
+    result = from_bytes(sample).best()
+    if result:
+        try:
+            return str(body, result.encoding, 'ignore')
+        except LookupError: pass
+    return str(body, 'utf-8', 'ignore')
 
 def extract_article_data(html: str) -> Dict[str, Optional[str]]:
+    if USE_SELECTOLAX:
+        return extract_article_data_selectolax(html)
+    return extract_article_data_bs4(html)
+
+def node_text(node, separator: str = '') -> str:
+    """等同于 BeautifulSoup 的 get_text(separator, strip=True)：每段文字去掉首尾空白，跳过空段后再拼接。"""
+    parts = (n.text_content.strip() for n in node.traverse(include_text=True) if n.tag == '-text')
+    return separator.join(p for p in parts if p)
+
+def node_texts(nodes) -> List[str]:
+    return [node_text(node) for node in nodes]
+
+def without_home(tags: List[str]) -> List[str]:
+    return [t for t in tags if t.lower() != 'home']  # 排除 'home'
+
+def extract_article_data_selectolax(html: str) -> Dict[str, Optional[str]]:
+    """
+    与 extract_article_data_bs4 提取相同的字段。
+    class_=re.compile(r'xxx') 对应 CSS 的 [class*="xxx"]，rel='author' 对应 [rel~="author"]。
+    """
+    tree = HTMLParser(html)
+
+    # ===== 标题 =====
+    title_tag = tree.css_first('h1[class*="content__headline"]')
+    title = node_text(title_tag) if title_tag else None
+
+    # ===== 发布时间 =====
+    time_tag = tree.css_first('time[itemprop="datePublished"]')
+    publish_time = time_tag.attributes.get('datetime') if time_tag else None
+
+    # ===== 作者 =====
+    author_tag = tree.css_first('a[rel~="author"]')
+    author = node_text(author_tag) if author_tag else None
+
+    # ===== 正文内容 =====
+    article_body_tag = tree.css_first('div[itemprop="articleBody"]') or tree.css_first('div[class*="content__article-body"]')
+
+    text = ""
+    if article_body_tag:
+        # strip_tags 在 C 里一次找出并删除这些子树，不再逐个节点回到 Python 调用 decompose
+        article_body_tag.strip_tags(['script', 'style', 'aside'])
+        text = node_text(article_body_tag, '\n')
+
+    # ===== (1) 顶部导航标签 signposting =====
+    signposting_tags = []
+
+    # 1 浅蓝色
+    signposting_ul = tree.css_first('ul[class*="signposting"]')
+    if signposting_ul:
+        a_tags = [li.css_first('a') for li in signposting_ul.css('li[class*="signposting__item"]')]
+        signposting_tags = without_home(node_texts(a for a in a_tags if a))
+
+    # 2 深蓝色
+    if not signposting_tags:
+        subnav_ul = tree.css_first('ul[class*="subnav__list"]')
+        if subnav_ul:
+            a_tags = [li.css_first('a[class*="subnav-link"]') for li in subnav_ul.css('li[class*="subnav__item"]')]
+            signposting_tags = without_home(node_texts(a for a in a_tags if a))
+
+    # 3 浅蓝色2
+    labels_div = tree.css_first('div[class*="content__labels"]')
+    if not signposting_tags and labels_div:
+        signposting_tags = without_home(node_texts(labels_div.css('a[href]')))
+
+    # ===== (2) 内容标签 content__labels =====
+    section_labels = node_texts(labels_div.css('a[class*="content__section-label__link"]')) if labels_div else []
+
+    # ===== (3) 关键词标签 submeta__keywords =====
+    keyword_tags = []
+
+    # 1 浅蓝色
+    keywords_div = tree.css_first('div[class*="submeta__keywords"]')
+    if keywords_div:
+        keyword_tags = node_texts(keywords_div.css('a[class*="submeta__link"]'))
+
+    # 2 深蓝色
+    if not keyword_tags:
+        keyword_list = tree.css_first('ul[class*="keyword-list"]')
+        if keyword_list:
+            keyword_tags = node_texts(keyword_list.css('a[itemprop="keywords"]'))
+
+    # 3 白色
+    if not keyword_tags:
+        submeta_links = tree.css_first('ul[class*="submeta__links"]')
+        if submeta_links:
+            keyword_tags = node_texts(submeta_links.css('a[class*="submeta__link"]'))
+
+    return {
+        "title": title,
+        "publish_time": publish_time,
+        "author": author,
+        "text": text,
+        "signposting_tags": signposting_tags,
+        "section_labels": section_labels,
+        "keyword_tags": keyword_tags
+    }
+
+def extract_article_data_bs4(html: str) -> Dict[str, Optional[str]]:
     soup = BeautifulSoup(html, 'lxml')
 
     # ===== 标题 =====
-    title_tag = soup.find('h1', class_=re.compile(r'content__headline'))
+    title_tag = soup.find('h1', class_=_CLASS_RE['content__headline'])
     title = title_tag.get_text(strip=True) if title_tag else None
 
     # ===== 发布时间 =====
@@ -73,7 +318,7 @@ def extract_article_data(html: str) -> Dict[str, Optional[str]]:
     # ===== 正文内容 =====
     article_body_tag = soup.find('div', attrs={'itemprop': 'articleBody'})
     if not article_body_tag:
-        article_body_tag = soup.find('div', class_=re.compile(r'content__article-body'))
+        article_body_tag = soup.find('div', class_=_CLASS_RE['content__article-body'])
     
     text = ""
     if article_body_tag:
@@ -85,9 +330,9 @@ def extract_article_data(html: str) -> Dict[str, Optional[str]]:
     signposting_tags = []
 
     # 1 浅蓝色
-    signposting_ul = soup.find('ul', class_=re.compile(r'signposting'))
+    signposting_ul = soup.find('ul', class_=_CLASS_RE['signposting'])
     if signposting_ul:
-        for li in signposting_ul.find_all('li', class_=re.compile(r'signposting__item')):
+        for li in signposting_ul.find_all('li', class_=_CLASS_RE['signposting__item']):
             a_tag = li.find('a')
             if a_tag:
                 tag_text = a_tag.get_text(strip=True)
@@ -96,10 +341,10 @@ def extract_article_data(html: str) -> Dict[str, Optional[str]]:
 
     # 2 深蓝色
     if not signposting_tags:
-        subnav_ul = soup.find('ul', class_=re.compile(r'subnav__list'))
+        subnav_ul = soup.find('ul', class_=_CLASS_RE['subnav__list'])
         if subnav_ul:
-            for li in subnav_ul.find_all('li', class_=re.compile(r'subnav__item')):
-                a_tag = li.find('a', class_=re.compile(r'subnav-link'))
+            for li in subnav_ul.find_all('li', class_=_CLASS_RE['subnav__item']):
+                a_tag = li.find('a', class_=_CLASS_RE['subnav-link'])
                 if a_tag:
                     tag_text = a_tag.get_text(strip=True)
                     if tag_text.lower() != 'home':
@@ -107,7 +352,7 @@ def extract_article_data(html: str) -> Dict[str, Optional[str]]:
 
     # 3 浅蓝色2
     if not signposting_tags:
-        labels_div = soup.find('div', class_=re.compile(r'content__labels'))
+        labels_div = soup.find('div', class_=_CLASS_RE['content__labels'])
         if labels_div:
             for a_tag in labels_div.find_all('a', href=True):
                 tag_text = a_tag.get_text(strip=True)
@@ -116,32 +361,32 @@ def extract_article_data(html: str) -> Dict[str, Optional[str]]:
 
     # ===== (2) 内容标签 content__labels =====
     section_labels = []
-    labels_div = soup.find('div', class_=re.compile(r'content__labels'))
+    labels_div = soup.find('div', class_=_CLASS_RE['content__labels'])
     if labels_div:
-        for a_tag in labels_div.find_all('a', class_=re.compile(r'content__section-label__link')):
+        for a_tag in labels_div.find_all('a', class_=_CLASS_RE['content__section-label__link']):
             section_labels.append(a_tag.get_text(strip=True))
 
     # ===== (3) 关键词标签 submeta__keywords =====
     keyword_tags = []
 
     # 1 浅蓝色
-    keywords_div = soup.find('div', class_=re.compile(r'submeta__keywords'))
+    keywords_div = soup.find('div', class_=_CLASS_RE['submeta__keywords'])
     if keywords_div:
-        for a_tag in keywords_div.find_all('a', class_=re.compile(r'submeta__link')):
+        for a_tag in keywords_div.find_all('a', class_=_CLASS_RE['submeta__link']):
             keyword_tags.append(a_tag.get_text(strip=True))
 
     # 2 深蓝色
     if not keyword_tags:  # 如果前者没找到，尝试新版结构
-        keyword_list = soup.find('ul', class_=re.compile(r'keyword-list'))
+        keyword_list = soup.find('ul', class_=_CLASS_RE['keyword-list'])
         if keyword_list:
             for a_tag in keyword_list.find_all('a', itemprop='keywords'):
                 keyword_tags.append(a_tag.get_text(strip=True))
 
     # 3 白色
     if not keyword_tags:
-        submeta_links = soup.find('ul', class_=re.compile(r'submeta__links'))
+        submeta_links = soup.find('ul', class_=_CLASS_RE['submeta__links'])
         if submeta_links:
-            for a_tag in submeta_links.find_all('a', class_=re.compile(r'submeta__link')):
+            for a_tag in submeta_links.find_all('a', class_=_CLASS_RE['submeta__link']):
                 keyword_tags.append(a_tag.get_text(strip=True))
 
     # ===== 返回结构化结果 =====
@@ -155,7 +400,7 @@ def extract_article_data(html: str) -> Dict[str, Optional[str]]:
         "keyword_tags": keyword_tags            # 关键词标签
     }
 
-def process_single_file(filename: str) -> Optional[Dict]:
+def process_single_file(filename: str) -> Union[bytes, Dict]:
     """
     处理单个文件的完整流程：读取、解析、提取。
     这个函数会被分发到多个进程中并行执行。
@@ -164,19 +409,22 @@ def process_single_file(filename: str) -> Optional[Dict]:
         base_name = os.path.splitext(os.path.splitext(filename)[0])[0]
         input_path = os.path.join(INPUT_DIR, filename)
 
-        with open(input_path, "rb") as f:
-            warc_bytes = f.read()
-
-        html_content = extract_html_from_warc(warc_bytes)
+        with open_warc_bytes(input_path) as warc_bytes:
+            html_content = extract_html_from_warc(warc_bytes)
         if not html_content or not html_content.strip():
             raise ValueError("Extracted HTML is empty.")
+        # 正文只会从这两类容器中提取：页面里连标记字符串都没有时（栏目首页、错误页等）
+        # 提取结果必然为空，直接判为失败，省掉整页解析
+        if not any(marker in html_content for marker in ARTICLE_BODY_MARKERS):
+            raise ValueError("Not an article page (no article body container).")
         
         article_data = extract_article_data(html_content)
         if not article_data.get("text") or not article_data["text"].strip():
             raise ValueError("Extracted article text is empty.")
         
-        # 返回包含ID和提取数据的完整记录
-        return {"id": base_name, **article_data}
+        # 在子进程里直接序列化成一行 JSON 返回：orjson 输出的 UTF-8 bytes 比 dict 传回主进程时的 pickle 更小，
+        # 序列化也随子进程并行，主进程只负责写文件
+        return orjson.dumps({"id": base_name, **article_data}) + b"\n"
 
     except Exception as e:
         # 在并行模式下，直接打印错误或返回特定标识符
@@ -187,17 +435,47 @@ def process_single_file(filename: str) -> Optional[Dict]:
 
 # ========== 主进程逻辑 ==========
 
-def load_processed_ids(dir_path: str) -> set:
-    processed_ids = set()
+def iter_warc_files(dir_path: str):
+    """
+    用 os.scandir 列出目录中的 .warc.gz 文件名（跳过 macOS 的 ._ 元数据文件）。
+    is_file() 直接使用读目录时得到的文件类型，不会对每个文件再 stat 一次。
+    """
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            name = entry.name
+            if name.endswith('.warc.gz') and not name.startswith('._') and entry.is_file():
+                yield name
+
+def id_key(record_id: bytes) -> int:
+    """把记录 ID 映射成 64 位哈希，已处理集合里只存这个整数而不是字符串（碰撞概率可忽略）"""
+    return int.from_bytes(hashlib.blake2b(record_id, digest_size=8).digest(), "little")
+
+def load_processed_ids(dir_path: str):
+    """
+    扫描输出目录中的 JSONL，收集已处理记录 ID 的哈希。
+    输出行都由 process_single_file 写出，以 {"id":"...", 开头，直接切出 ID 字节，不做 JSON 解析；
+    格式不符的行才退回 orjson。安装了 pyroaring 时返回 BitMap64，否则返回整数集合。
+    """
+    processed_ids = BitMap64() if BitMap64 is not None else set()
+    prefix = b'{"id":"'
     for filepath in glob.glob(os.path.join(dir_path, "*.jsonl")):
+        keys = []
         try:
-            with open(filepath, "r", encoding="utf-8") as f:
+            with open(filepath, "rb") as f:
                 for line in f:
+                    if line.startswith(prefix):
+                        end = line.find(b'"', len(prefix))
+                        record_id = line[len(prefix):end]
+                        # ID 里有转义字符时切出来的不是原始值，交给 JSON 解析
+                        if end != -1 and b"\\" not in record_id:
+                            keys.append(id_key(record_id))
+                            continue
                     if line.strip():
-                        record = json.loads(line)
+                        record = orjson.loads(line)
                         if 'id' in record:
-                            processed_ids.add(record['id'])
-        except (json.JSONDecodeError, IOError): pass
+                            keys.append(id_key(record['id'].encode("utf-8")))
+        except (orjson.JSONDecodeError, IOError): pass
+        processed_ids.update(keys)
     return processed_ids
 
 def main():
@@ -209,10 +487,11 @@ def main():
     if processed_ids:
         print(f"已找到 {len(processed_ids)} 个已处理的记录，将跳过它们。")
 
-    all_warc_files = sorted([f for f in os.listdir(INPUT_DIR) if f.endswith('.warc.gz') and not f.startswith('._')])
+    all_warc_files = sorted(iter_warc_files(INPUT_DIR))
+    # iter_warc_files 只返回 .warc.gz 文件，直接切掉后缀得到ID
     files_to_process = [
-        f for f in all_warc_files 
-        if os.path.splitext(os.path.splitext(f)[0])[0] not in processed_ids
+        f for f in all_warc_files
+        if id_key(f[:-len('.warc.gz')].encode("utf-8")) not in processed_ids
     ]
             
     if not files_to_process:
@@ -225,7 +504,7 @@ def main():
     # 使用 multiprocessing.Pool 来并行处理文件
     with Pool(processes=NUM_PROCESSES) as pool:
         # 使用 imap_unordered 来获得最佳性能，它会按完成顺序返回结果
-        results_iterator = pool.imap_unordered(process_single_file, files_to_process)
+        results_iterator = pool.imap_unordered(process_single_file, files_to_process, chunksize=POOL_CHUNKSIZE)
         
         # 使用 tqdm 显示进度
         pbar = tqdm(total=len(files_to_process), desc="处理进度")
@@ -239,7 +518,7 @@ def main():
         try:
             for result in results_iterator:
                 if result:
-                    if result.get("_error"):
+                    if isinstance(result, dict):
                         # 记录失败
                         log_f.write(f"{result['filename']}\t{result['reason']}\n")
                     else:
@@ -249,12 +528,12 @@ def main():
                                 output_file_handle.close()
                             
                             output_path = os.path.join(OUTPUT_DATA_DIR, f"data_{chunk_index:05d}.jsonl")
-                            output_file_handle = open(output_path, "a", encoding="utf-8")
+                            output_file_handle = open(output_path, "ab", buffering=WRITE_BUFFER_SIZE)
                             chunk_index += 1
                             records_in_current_chunk = 0
                         
                         # 写入成功的结果
-                        output_file_handle.write(json.dumps(result, ensure_ascii=False) + '\n')
+                        output_file_handle.write(result)
                         records_in_current_chunk += 1
                 
                 # 更新进度条
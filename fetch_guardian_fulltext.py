@@ -1,36 +1,114 @@
 import os
-import json
+import orjson
 import hashlib
 import requests
+from requests.adapters import HTTPAdapter
 import time
+import random
 import re
-import io
+import threading
+import asyncio
 import gzip
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import RequestException, ChunkedEncodingError, ConnectionError, ReadTimeout
 from charset_normalizer import from_bytes
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+# 安装了 cchardet（faust-cchardet）时用它探测编码，比 charset_normalizer 快得多
+try:
+    import cchardet
+except ImportError:
+    cchardet = None
+# 安装了 isal（Intel ISA-L 的 Python 绑定）时用它的 SIMD 实现解压 gzip，接口和异常与 gzip 模块一致
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+# 安装了 deflate（libdeflate 的 Python 绑定）时优先用它整块解压，单个 gzip 成员时比 ISA-L 还快
+try:
+    import deflate
+except ImportError:
+    deflate = None
 
 # ========== 配置 ==========
 INPUT_JSONL = "guardian_index_world_merged.jsonl"
 OUTPUT_DIR = "guardian_world_pages"
 LOG_FILE = "failed.log"
 BASE_URL = "https://data.commoncrawl.org/"
+MAX_WORKERS = 16  # 并发下载的线程数
+MAX_FUTURES_IN_FLIGHT = MAX_WORKERS * 4  # 最多同时挂起的下载任务数
+MAX_RETRY_AFTER = 300  # 服务器要求的 Retry-After 最多等待这么多秒
+# 安装了 aiohttp 时改用 asyncio 下载：一个事件循环管理所有连接，并发请求数可以比线程数高
+USE_ASYNC = aiohttp is not None
+ASYNC_CONCURRENCY = 64
+# 探测编码时（cchardet 或 charset_normalizer）只看响应体的前这么多字节，超大页面不会拖慢探测
+CHARSET_SNIFF_BYTES = 65536
+
+# libdeflate 处理不了时使用的 gzip 解压函数：优先用 ISA-L
+_gzip_decompress = igzip.decompress if igzip is not None else gzip.decompress
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+log_lock = threading.Lock()
+# 失败日志在 main 中只打开一次，各线程加锁后写入；带缓冲，不再每条失败都 open/close 一次
+log_file = None
+
+# 全局共享的 Session：所有线程复用 keep-alive 连接，避免每个请求都重新握手
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=0))
+
 
 # ========== 工具函数 ==========
+# 正则在模块加载时编译一次，不在每条记录上重新查缓存
+_CHARSET_RE = re.compile(br"charset=([\w\-]+)", re.IGNORECASE)
+
+def gzip_decompress(data: bytes) -> bytes:
+    """
+    优先用 libdeflate 解压。它只解第一个 gzip 成员，输出缓冲区按最后 4 字节（最后一个成员的 ISIZE）分配：
+    多成员数据不一定报错，可能只返回第一个成员。所以只有解出的长度与 ISIZE 一致时才采用它的结果，
+    否则（多个成员、不是 gzip 数据等）交给 ISA-L / zlib 再解一次，异常也由它们按 gzip 模块的约定抛出。
+    """
+    if deflate is not None:
+        try:
+            out = deflate.gzip_decompress(data)
+            if len(out) & 0xFFFFFFFF == int.from_bytes(data[-4:], "little"):
+                return out
+        except (deflate.DeflateError, ValueError):
+            pass
+    return _gzip_decompress(data)
+
+
 def safe_filename(url: str) -> str:
     """将URL转换为安全文件名"""
     h = hashlib.md5(url.encode()).hexdigest()
     return f"{h}.html"
 
 
-def fetch_segment(record, retries=3, backoff=2):
-    """根据CDX记录下载对应的网页片段"""
-    warc_path = record["filename"]
-    offset = int(record["offset"])
-    length = int(record["length"])
+def retry_after_delay(headers, default):
+    """
+    服务器在 429/503 等响应里给出 Retry-After 时按它的要求等待（秒数或 HTTP 日期），
+    否则使用默认的退避时间。
+    """
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return default
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return default
+    return min(max(delay, 0), MAX_RETRY_AFTER)
+
+
+def fetch_segment(warc_path, offset, length, retries=3, backoff=2):
+    """根据CDX记录中的 filename/offset/length 下载对应的网页片段"""
     end = offset + length - 1
 
     warc_url = BASE_URL + warc_path
@@ -38,21 +116,46 @@ def fetch_segment(record, retries=3, backoff=2):
 
     for attempt in range(retries):
         try:
-            resp = requests.get(warc_url, headers=headers, timeout=60)
+            resp = SESSION.get(warc_url, headers=headers, timeout=60)
             resp.raise_for_status()
             return resp.content
         except (ChunkedEncodingError, ConnectionError, ReadTimeout, RequestException) as e:
             if attempt < retries - 1:
-                time.sleep(backoff * (attempt + 1))
+                # 退避时间完全随机（full jitter），被限流时各线程不会在同一时刻一起重试；
+                # 429/503 带了 Retry-After 时按服务器的要求等待
+                response = getattr(e, "response", None)
+                limited = response is not None and response.status_code in (429, 503)
+                delay = random.uniform(0, backoff * (2 ** attempt))
+                time.sleep(retry_after_delay(response.headers if limited else None, delay))
             else:
                 raise e
 
 
+async def fetch_segment_async(session, sem, warc_path, offset, length, retries=3, backoff=2):
+    """fetch_segment 的 asyncio 版本。重试等待期间不占用并发名额。"""
+    end = offset + length - 1
+    warc_url = BASE_URL + warc_path
+    headers = {"Range": f"bytes={offset}-{end}"}
+
+    for attempt in range(retries):
+        try:
+            async with sem, session.get(warc_url, headers=headers) as resp:
+                resp.raise_for_status()
+                return await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt < retries - 1:
+                limited = isinstance(e, aiohttp.ClientResponseError) and e.status in (429, 503)
+                delay = random.uniform(0, backoff * (2 ** attempt))
+                await asyncio.sleep(retry_after_delay(e.headers if limited else None, delay))
+            else:
+                raise
+
+
 def maybe_decompress(warc_bytes: bytes) -> bytes:
     """尝试解压 gzip 数据"""
     try:
-        with gzip.GzipFile(fileobj=io.BytesIO(warc_bytes)) as f:
-            return f.read()
+        # 直接整块解压，不再经过 BytesIO + GzipFile 的流式读取多拷贝一次
+        return gzip_decompress(warc_bytes)
     except OSError:
         # 不是 gzip 格式，原样返回
         return warc_bytes
@@ -64,77 +167,193 @@ def extract_http_payload(warc_bytes: bytes):
         # Step 1: gzip 解压
         raw_bytes = maybe_decompress(warc_bytes)
 
-        # Step 2: 解码 header + body
-        text = raw_bytes.decode("iso-8859-1", errors="ignore")
-        parts = text.split("\r\n\r\n", 2)
-        if len(parts) < 3:
-            return text
+        # Step 2: 在字节上定位 WARC 头、HTTP 头和正文的分界，不再把整段内容解码成 str 再编码回来
+        header_end = raw_bytes.find(b"\r\n\r\n")
+        http_header_end = raw_bytes.find(b"\r\n\r\n", header_end + 4) if header_end != -1 else -1
+        if http_header_end == -1:
+            return raw_bytes.decode("iso-8859-1", errors="ignore")
 
-        http_headers = parts[1]
-        body_bytes = parts[2].encode("iso-8859-1", errors="ignore")
+        body = memoryview(raw_bytes)[http_header_end + 4:]
 
         # Step 3: 从 HTTP 头提取 charset
-        match = re.search(r"charset=([\w\-]+)", http_headers, re.IGNORECASE)
+        match = _CHARSET_RE.search(raw_bytes, header_end + 4, http_header_end)
         if match:
-            encoding = match.group(1)
+            encoding = match.group(1).decode("ascii")
             try:
-                return body_bytes.decode(encoding, errors="ignore")
+                return str(body, encoding, "ignore")
             except Exception:
                 pass
 
-        # Step 4: 自动检测编码
-        result = from_bytes(body_bytes).best()
+        # Step 4: 绝大多数页面是 UTF-8，能严格按 UTF-8 解码就不再做代价很高的编码探测
+        try:
+            return str(body, "utf-8")
+        except UnicodeDecodeError:
+            pass
+
+        # Step 5: 自动检测编码，优先用 cchardet，没有安装时用 charset_normalizer
+        # 只取前 CHARSET_SNIFF_BYTES 字节做探测，并截在最后一个换行处，避免把多字节字符切成两半
+        sample = bytes(body[:CHARSET_SNIFF_BYTES])
+        if len(body) > CHARSET_SNIFF_BYTES:
+            cut = sample.rfind(b"\n")
+            if cut > 0:
+                sample = sample[:cut + 1]
+
+        if cchardet is not None:
+            encoding = cchardet.detect(sample)["encoding"] or "utf-8"
+            try:
+                return str(body, encoding, "ignore")
+            except LookupError:
+                return str(body, "utf-8", "ignore")
+
+        # 探测结果只用来确定编码，再用它解码完整的响应体
+        result = from_bytes(sample).best()
         if result:
-            return str(result)
-        else:
-            return body_bytes.decode("utf-8", errors="ignore")
+            try:
+                return str(body, result.encoding, "ignore")
+            except LookupError:
+                pass
+        return str(body, "utf-8", "ignore")
 
     except Exception as e:
         return warc_bytes.decode("utf-8", errors="ignore")
 
 
 def log_failure(url, reason):
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(f"{url}\t{reason}\n")
+    with log_lock:
+        log_file.write(f"{url}\t{reason}\n")
 
 
 # ========== 主逻辑 ==========
-def main():
-    with open(INPUT_JSONL, "r", encoding="utf-8") as f:
-        lines = [json.loads(line) for line in f if line.strip()]
+def save_page(output_path, warc_bytes):
+    """提取正文并写入 output_path。"""
+    html = extract_http_payload(warc_bytes)
 
-    print(f"共 {len(lines)} 条索引记录。开始下载……")
+    # 先写临时文件再改名：中途退出不会留下残缺的 .html，下次运行也不会把它当成已下载
+    tmp_path = output_path + ".part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(html)
+    os.replace(tmp_path, output_path)
 
-    for record in tqdm(lines, desc="下载进度"):
-        url = record.get("url")
-        status = record.get("status")
 
-        # 跳过非 200 状态
-        if status != "200":
-            continue
+def process_record(task):
+    """下载并提取单条记录的正文，在线程池中执行。返回是否成功。"""
+    url, warc_path, offset, length, output_path = task
+    try:
+        warc_bytes = fetch_segment(warc_path, offset, length)
+        save_page(output_path, warc_bytes)
+        return True
+    except RequestException as e:
+        log_failure(url, f"request_error: {str(e)}")
+    except Exception as e:
+        log_failure(url, f"parse_error: {e}")
+    return False
 
-        filename = safe_filename(url)
-        output_path = os.path.join(OUTPUT_DIR, filename)
 
-        # 已下载跳过
-        if os.path.exists(output_path):
-            continue
+async def process_record_async(session, sem, task):
+    """process_record 的 asyncio 版本，提取正文和写文件交给线程池，不阻塞事件循环。"""
+    url, warc_path, offset, length, output_path = task
+    try:
+        warc_bytes = await fetch_segment_async(session, sem, warc_path, offset, length)
+        await asyncio.get_running_loop().run_in_executor(None, save_page, output_path, warc_bytes)
+        return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log_failure(url, f"request_error: {type(e).__name__}: {e}")
+    except Exception as e:
+        log_failure(url, f"parse_error: {e}")
+    return False
+
+
+async def download_all_async(task_generator, pbar):
+    """
+    用一个共享的 aiohttp ClientSession 下载所有记录。
+    最多同时进行 ASYNC_CONCURRENCY 个请求、挂起 ASYNC_CONCURRENCY * 2 个任务，不会把整个索引读进内存。
+    """
+    connector = aiohttp.TCPConnector(limit=ASYNC_CONCURRENCY, limit_per_host=ASYNC_CONCURRENCY, ttl_dns_cache=600)
+    timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=60)
+    sem = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    max_pending = ASYNC_CONCURRENCY * 2
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        pending = set()
+        for task in task_generator:
+            if len(pending) >= max_pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pbar.update(len(done))
+            pending.add(asyncio.ensure_future(process_record_async(session, sem, task)))
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pbar.update(len(done))
+
+
+def generate_tasks(existing, stats):
+    """
+    流式读取索引，逐条产出待下载的任务元组，不再先把所有任务收集成列表：
+    内存占用与索引大小无关，第一批请求也不必等整个索引解析完才发出。
+    """
+    # 二进制读取，orjson 直接解析 bytes，省去逐行解码
+    with open(INPUT_JSONL, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            stats["total"] += 1
+            record = orjson.loads(line)
+
+            # 直接下标取值：常见情况下字段都在，一次查找即可；缺少状态或 URL 的记录走 KeyError 跳过
+            try:
+                # 跳过非 200 状态
+                if record["status"] != "200":
+                    continue
+                url = record["url"]
+            except KeyError:
+                continue
 
-        try:
-            warc_bytes = fetch_segment(record)
-            html = extract_http_payload(warc_bytes)
+            filename = safe_filename(url)
 
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(html)
+            # 已下载跳过；同一 URL 在索引里出现多次时也只下载一次
+            if filename in existing:
+                continue
 
-            time.sleep(0.2)
-        except RequestException as e:
-            log_failure(url, f"request_error: {str(e)}")
-        except Exception as e:
-            log_failure(url, f"parse_error: {e}")
+            # 缺少 filename/offset/length 或取值不是数字的记录无法下载，记入失败日志后跳过，不中断整个任务
+            try:
+                task = (url, record["filename"], int(record["offset"]), int(record["length"]))
+            except (KeyError, ValueError, TypeError) as e:
+                log_failure(url, f"parse_error: {e}")
+                continue
+            existing.add(filename)
+            stats["queued"] += 1
+            yield task + (os.path.join(OUTPUT_DIR, filename),)
 
-    print("✅ 下载完成！失败记录已写入 failed.log")
 
+def main():
+    global log_file
+    # 已下载的文件名一次性读入集合，不再每条记录都 os.path.exists 做一次 stat
+    existing = set(os.listdir(OUTPUT_DIR))
+    stats = {"total": 0, "queued": 0}
+    print("开始边读索引边下载……")
+
+    log_file = open(LOG_FILE, "a", encoding="utf-8", buffering=1 << 16)
+    try:
+        with tqdm(desc="下载进度", unit="条") as pbar:
+            if USE_ASYNC:
+                asyncio.run(download_all_async(generate_tasks(existing, stats), pbar))
+            else:
+                # 各条记录互相独立，用线程池并发下载。信号量限制同时挂起的任务数：
+                # 提交前 acquire，任务完成的回调里 release，不再一次性为所有任务创建 future
+                in_flight = threading.Semaphore(MAX_FUTURES_IN_FLIGHT)
+
+                def on_done(future):
+                    in_flight.release()
+                    pbar.update(1)
+
+                with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                    for task in generate_tasks(existing, stats):
+                        in_flight.acquire()
+                        executor.submit(process_record, task).add_done_callback(on_done)
+    finally:
+        log_file.close()
+
+    print(f"共 {stats['total']} 条索引记录，本次下载 {stats['queued']} 条。")
+    print("✅ 下载完成！失败记录已写入 failed.log")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,4 +1,5 @@
 # filter_jsonl_fast.py
+import mmap
 import os
 from tqdm import tqdm
 
@@ -11,71 +12,126 @@ from tqdm import tqdm
 SOURCE_JSONL = "guardian_index_all.jsonl" 
 OUTPUT_JSONL = "guardian_index_200_only.jsonl"
 
-def count_lines(filename):
-    """高效地计算文件行数，用于tqdm进度条。"""
-    try:
-        with open(filename, 'rb') as f:
-            lines = 0
-            buf_size = 1024 * 1024 * 8 # 使用更大的缓冲区
-            read_f = f.raw.read
-            buf = read_f(buf_size)
-            while buf:
-                lines += buf.count(b'\n')
-                buf = read_f(buf_size)
-        return lines
-    except FileNotFoundError:
-        return 0
+# 每次从映射中取出处理的窗口大小（几 MB 能留在 CPU 缓存附近，比一次取很大更快），以及输出缓冲攒到多大再写一次
+WINDOW_SIZE = 4 * 1024 * 1024  # 4MB
+WRITE_BATCH_SIZE = 64 * 1024 * 1024  # 64MB
+# 窗口内保留行数 * 该值 < 行数时视为稀疏，下一个窗口改用 find 跳跃的方式筛选
+SPARSE_HIT_RATIO = 4
+
+def iter_matching_spans(data, targets):
+    """
+    在 data（若干整行，最后一行可以没有换行符）中找出包含任一 target 的行，产出连续区间 (start, end)。
+    直接用 bytes.find 跳到下一个命中的位置再回找行首行尾，不匹配的行完全在 C 里跳过；
+    相邻的命中行合并成一段，减少写入次数。
+    """
+    next_hits = [data.find(t) for t in targets]
+    run_start = run_end = -1
+    while True:
+        hits = [i for i in next_hits if i != -1]
+        if not hits:
+            break
+        hit = min(hits)
+        line_start = data.rfind(b"\n", 0, hit) + 1
+        line_end = data.find(b"\n", hit) + 1
+        if line_end == 0:
+            line_end = len(data)
+        if line_start == run_end:
+            run_end = line_end
+        else:
+            if run_end != -1:
+                yield run_start, run_end
+            run_start, run_end = line_start, line_end
+        # 已越过的命中（同一行里可能两种写法都有）重新向后查找
+        next_hits = [i if i == -1 or i >= line_end else data.find(t, line_end)
+                     for i, t in zip(next_hits, targets)]
+    if run_end != -1:
+        yield run_start, run_end
 
 def filter_records_fast():
     """
     极速筛选版本：
     不使用 json.loads() 解析每一行，而是直接进行字符串检查。
     这对于格式固定的 JSONL 文件来说，速度极快。
+    不再为了进度条的总数先完整读一遍文件数行数：进度条按已读取的字节数推进。
+    源文件通过 mmap 映射，按 WINDOW_SIZE 大小的整行窗口处理：
+    命中稀疏的窗口只在命中的位置回找行边界，Python 层的循环次数与保留的连续片段数成正比，而不是总行数；
+    命中密集的窗口则整块切行后用列表推导筛选。
     """
     print(f"开始处理源文件: {SOURCE_JSONL} (快速模式)")
     
-    total_lines = count_lines(SOURCE_JSONL)
-    if total_lines == 0:
+    try:
+        total_bytes = os.path.getsize(SOURCE_JSONL)
+    except FileNotFoundError:
+        total_bytes = 0
+    if total_bytes == 0:
         print("错误：源文件为空或不存在。")
         return
 
+    total_lines = 0
     kept_count = 0
-    skipped_count = 0
     
     # 定义我们要搜索的精确子字符串
     # 检查两种常见情况：带空格和不带空格
-    target_substring_1 = '"status":"200"'
-    target_substring_2 = '"status": "200"'
+    # 以二进制方式读写，直接在字节上查找，省去 UTF-8 解码和编码
+    targets = (b'"status":"200"', b'"status": "200"')
 
     try:
-        # 增加读写缓冲区大小，可以提高I/O性能
-        buffer_size = 1024 * 1024 * 8  # 8MB buffer
-
-        with open(SOURCE_JSONL, "r", encoding="utf-8", buffering=buffer_size) as infile, \
-             open(OUTPUT_JSONL, "w", encoding="utf-8", buffering=buffer_size) as outfile:
+        with open(SOURCE_JSONL, "rb") as infile, \
+             mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+             open(OUTPUT_JSONL, "wb", buffering=0) as outfile:
             
-            # 使用 enumerate 来减少 tqdm 更新的频率，降低开销
-            progress_bar = tqdm(enumerate(infile), total=total_lines, desc="筛选记录", unit="行")
+            progress_bar = tqdm(total=total_bytes, desc="筛选记录", unit="B", unit_scale=True)
+            out_buf = bytearray()
+            sparse = False
             
-            for i, line in progress_bar:
-                # 核心优化：使用字符串 'in' 操作，而不是 json.loads()
-                if target_substring_1 in line or target_substring_2 in line:
-                    outfile.write(line)
-                    kept_count += 1
+            pos = 0
+            while pos < total_bytes:
+                # 窗口末尾对齐到下一个换行，保证窗口里都是完整的行
+                end = mm.find(b"\n", min(pos + WINDOW_SIZE, total_bytes) - 1)
+                end = total_bytes if end == -1 else end + 1
+                data = mm[pos:end]
+                
+                if sparse:
+                    # 命中稀疏：只在命中处回找行边界，不匹配的行在 C 里整段跳过
+                    line_count = data.count(b"\n") + (not data.endswith(b"\n"))
+                    window_kept = 0
+                    for start, stop in iter_matching_spans(data, targets):
+                        out_buf += data[start:stop]
+                        # 每个区间内的行数等于其中的换行数（末尾缺换行的最后一行单独补上）
+                        window_kept += data.count(b"\n", start, stop) + (data[stop - 1] != 0x0A)
                 else:
-                    skipped_count += 1
+                    # 命中密集：逐个回找边界反而更慢，直接切行后用列表推导筛选
+                    lines = data.split(b"\n")
+                    line_count = len(lines) - (lines[-1] == b"")
+                    kept = [line for line in lines if targets[0] in line or targets[1] in line]
+                    if kept:
+                        out_buf += b"\n".join(kept)
+                        if kept[-1] is not lines[-1]:
+                            out_buf += b"\n"
+                    window_kept = len(kept)
                 
-                # 每 10000 行更新一次 postfix，减少tqdm的性能开销
-                if i % 10000 == 0:
-                    progress_bar.set_postfix_str(f"保留={kept_count}, 跳过={skipped_count}")
-
-            # 确保最后一次的统计数据被设置
-            progress_bar.set_postfix_str(f"保留={kept_count}, 跳过={skipped_count}")
+                total_lines += line_count
+                kept_count += window_kept
+                # 根据本窗口的命中密度决定下一个窗口用哪种方式（相邻窗口的分布通常接近）
+                sparse = window_kept * SPARSE_HIT_RATIO < line_count
+                
+                if len(out_buf) >= WRITE_BATCH_SIZE:
+                    outfile.write(out_buf)
+                    out_buf.clear()
+                
+                progress_bar.update(end - pos)
+                pos = end
+            
+            if out_buf:
+                outfile.write(out_buf)
+            progress_bar.close()
 
     except FileNotFoundError:
         print(f"错误: 输入文件 '{SOURCE_JSONL}' 未找到。")
         return
 
+    skipped_count = total_lines - kept_count
+
     print("\n✅ 筛选完成!")
     print("========== 结果统计 ==========")
     print(f"  总共处理行数: {total_lines}")
@@ -2,19 +2,54 @@
 import os
 import re
 import gzip
+import mmap
+import glob
+import orjson
+from contextlib import contextmanager
 from functools import partial
 from tqdm import tqdm
 from charset_normalizer import from_bytes
+# 安装了 cchardet（faust-cchardet）时用它探测编码，比 charset_normalizer 快得多
+try:
+    import cchardet
+except ImportError:
+    cchardet = None
 from multiprocessing import Pool, cpu_count
+# 安装了 isal（Intel ISA-L 的 Python 绑定）时用它的 SIMD 实现解压 gzip，接口和异常与 gzip 模块一致
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+# 安装了 deflate（libdeflate 的 Python 绑定）时优先用它整块解压，单个 gzip 成员时比 ISA-L 还快
+try:
+    import deflate
+except ImportError:
+    deflate = None
 
 # ========== 配置 ==========
 # INPUT_DIR = "guardian_world_warc_segments"
 INPUT_DIR = "/Users/yangqian/Downloads/commoncrawl/sample_100/batch_0000"
 OUTPUT_HTML_DIR = "sample_100_html"  # 输出目录名更改，更符合内容
 LOG_FILE = "html_extraction_failed.log"
+# 输出格式："html" 每个页面单独保存成 xxxx.html（默认，可直接用浏览器打开）；
+# "jsonl" 每个页面一行 {"id": ..., "html": ...}，由主进程按 FILES_PER_CHUNK 分块追加到 html_XXXXX.jsonl，
+# 不再为每个页面创建一个文件，适合整批提取后交给下游脚本读取
+OUTPUT_FORMAT = "html"
+FILES_PER_CHUNK = 10000
+# jsonl 输出的写缓冲：记录已在子进程序列化成 bytes，攒满这么多再交给系统写一次
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024  # 8MB
 
 # 使用所有可用的CPU核心数减一，留一个给系统
 NUM_PROCESSES = max(1, cpu_count() - 1) 
+# 每次给子进程派发这么多个文件，减少单个小文件任务的进程间通信开销
+POOL_CHUNKSIZE = 32
+# 探测编码时（cchardet 或 charset_normalizer）只看响应体的前这么多字节，超大页面不会拖慢探测
+CHARSET_SNIFF_BYTES = 65536
+# 不小于这个大小的输入文件用 mmap 映射后直接解压，不再先整份读进内存
+MMAP_MIN_BYTES = 8 * 1024 * 1024
+
+# libdeflate 处理不了时使用的 gzip 解压函数：优先用 ISA-L
+_gzip_decompress = igzip.decompress if igzip is not None else gzip.decompress
 
 # 创建输出目录
 os.makedirs(OUTPUT_HTML_DIR, exist_ok=True)
@@ -22,6 +57,76 @@ os.makedirs(OUTPUT_HTML_DIR, exist_ok=True)
 
 # ========== 解析函数 (将在子进程中运行) ==========
 
+# 正则在模块加载时编译一次，不在每个文件上重新查缓存
+_CHARSET_RE = re.compile(br"charset=([\w\-]+)", re.IGNORECASE)
+
+@contextmanager
+def open_warc_bytes(path: str):
+    """
+    读入整个 WARC 文件供解压。小文件用 os.open/os.read 读成 bytes，省掉 open() 为每个小文件创建
+    BufferedReader 的开销；按 fstat 得到的大小多请求 1 字节，一次返回不足即已到文件末尾。
+    不小于 MMAP_MIN_BYTES 的文件改为只读 mmap，以 memoryview 交给解压函数，
+    压缩数据不再整份复制到进程内存里，由系统按需换入页面。
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size >= MMAP_MIN_BYTES:
+            # mmap 内部会复制一份文件描述符，这里的 fd 可以照常关闭
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        else:
+            mm = None
+            data = os.read(fd, size + 1)
+            if len(data) > size:
+                # 读取期间文件变大，或单次 read 有上限时，读到末尾为止
+                parts = [data]
+                while True:
+                    chunk = os.read(fd, 1 << 20)
+                    if not chunk:
+                        break
+                    parts.append(chunk)
+                data = b"".join(parts)
+    finally:
+        os.close(fd)
+
+    if mm is None:
+        yield data
+        return
+    with mm:
+        view = memoryview(mm)
+        try:
+            yield view
+        finally:
+            view.release()
+
+def write_file_bytes(path: str, data: bytes):
+    """
+    用 os.open/os.write 写出整个文件（已存在则截断），和读入时一样省掉 open() 创建文件对象的开销。
+    写普通文件时一次 os.write 通常就能写完，返回不足时接着写剩下的部分。
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def gzip_decompress(data: bytes) -> bytes:
+    """
+    优先用 libdeflate 解压。它只解第一个 gzip 成员，输出缓冲区按最后 4 字节（最后一个成员的 ISIZE）分配：
+    多成员数据不一定报错，可能只返回第一个成员。所以只有解出的长度与 ISIZE 一致时才采用它的结果，
+    否则（多个成员、不是 gzip 数据等）交给 ISA-L / zlib 再解一次，异常也由它们按 gzip 模块的约定抛出。
+    """
+    if deflate is not None:
+        try:
+            out = deflate.gzip_decompress(data)
+            if len(out) & 0xFFFFFFFF == int.from_bytes(data[-4:], "little"):
+                return out
+        except (deflate.DeflateError, ValueError):
+            pass
+    return _gzip_decompress(data)
+
 def extract_html_from_warc(warc_bytes: bytes) -> str:
     """
     从WARC文件的原始字节中解压并提取HTML内容。
@@ -29,10 +134,10 @@ def extract_html_from_warc(warc_bytes: bytes) -> str:
     """
     try:
         # 首先尝试解压
-        raw_bytes = gzip.decompress(warc_bytes)
+        raw_bytes = gzip_decompress(warc_bytes)
     except (OSError, gzip.BadGzipFile):
-        # 如果失败（可能文件未压缩），则直接使用原始字节
-        raw_bytes = warc_bytes
+        # 如果失败（可能文件未压缩），则直接使用原始字节（输入是 mmap 的 memoryview 时复制成 bytes）
+        raw_bytes = bytes(warc_bytes)
     
     # WARC响应通常包含两个头部分：WARC头和HTTP头
     # 我们需要跳过这两个头，找到HTTP响应体
@@ -45,30 +150,57 @@ def extract_html_from_warc(warc_bytes: bytes) -> str:
     http_header_end = raw_bytes.find(b'\r\n\r\n', header_end + 4)
     if http_header_end == -1:
         # 如果没有HTTP头，则认为头部之后都是内容
-        return raw_bytes[header_end + 4:].decode('utf-8', errors='ignore')
+        return str(memoryview(raw_bytes)[header_end + 4:], 'utf-8', 'ignore')
     
-    # 提取HTTP头和响应体
-    http_headers_bytes = raw_bytes[header_end+4:http_header_end]
-    body_bytes = raw_bytes[http_header_end+4:]
+    # 提取HTTP头和响应体：HTTP 头直接在原缓冲区的区间内查找 charset，
+    # 响应体用 memoryview 切片，解码前都不复制
+    body = memoryview(raw_bytes)[http_header_end+4:]
 
     # 尝试从HTTP头的Content-Type中获取编码
-    match = re.search(br"charset=([\w\-]+)", http_headers_bytes, re.IGNORECASE)
+    match = _CHARSET_RE.search(raw_bytes, header_end+4, http_header_end)
     if match:
         try:
             encoding = match.group(1).decode('ascii')
-            return body_bytes.decode(encoding, errors='ignore')
+            return str(body, encoding, 'ignore')
         except (LookupError, UnicodeDecodeError):
             # 如果指定的编码无效，则继续使用自动检测
             pass
 
-    # 如果无法从头部获取编码，使用charset_normalizer进行自动检测
-    result = from_bytes(body_bytes).best()
-    return str(result) if result else body_bytes.decode('utf-8', errors='ignore')
+    # 绝大多数页面是 UTF-8：能严格按 UTF-8 解码就不再做代价很高的编码探测
+    try:
+        return str(body, 'utf-8')
+    except UnicodeDecodeError:
+        pass
+
+    # 如果无法从头部获取编码，自动检测：优先用 cchardet，没有安装时用 charset_normalizer
+    # 只取前 CHARSET_SNIFF_BYTES 字节做探测，并截在最后一个换行处，避免把多字节字符切成两半
+    sample = bytes(body[:CHARSET_SNIFF_BYTES])
+    if len(body) > CHARSET_SNIFF_BYTES:
+        cut = sample.rfind(b'\n')
+        if cut > 0:
+            sample = sample[:cut + 1]
 
+    if cchardet is not None:
+        encoding = cchardet.detect(sample)['encoding'] or 'utf-8'
+        try:
+            return str(body, encoding, 'ignore')
+        except LookupError:
+            return str(body, 'utf-8', 'ignore')
 
-def process_single_file(filename: str, input_dir: str, output_dir: str) -> dict:
+    # 探测结果只用来确定编码，再用它解码完整的响应体
+    result = from_bytes(sample).best()
+    if result:
+        try:
+            return str(body, result.encoding, 'ignore')
+        except LookupError:
+            pass
+    return str(body, 'utf-8', 'ignore')
+
+
+def process_single_file(filename: str, input_dir: str, output_dir: str, output_format: str = "html") -> dict:
     """
     处理单个文件的完整流程：读取、提取HTML、保存HTML。
+    output_format 为 "jsonl" 时不写文件，把序列化好的一行放在返回结果的 "line" 里交给主进程写入。
     这个函数会被分发到多个进程中并行执行。
     """
     try:
@@ -77,18 +209,18 @@ def process_single_file(filename: str, input_dir: str, output_dir: str) -> dict:
         input_path = os.path.join(input_dir, filename)
         output_path = os.path.join(output_dir, f"{base_name}.html")
 
-        # 1. 读取原始WARC文件
-        with open(input_path, "rb") as f:
-            warc_bytes = f.read()
-
-        # 2. 提取HTML内容
-        html_content = extract_html_from_warc(warc_bytes)
+        # 1. 读取原始WARC文件，2. 提取HTML内容
+        with open_warc_bytes(input_path) as warc_bytes:
+            html_content = extract_html_from_warc(warc_bytes)
         if not html_content or not html_content.strip():
             raise ValueError("Extracted HTML content is empty.")
         
-        # 3. 将提取的HTML写入新文件
-        with open(output_path, "w", encoding="utf-8") as f_out:
-            f_out.write(html_content)
+        if output_format == "jsonl":
+            return {"status": "success", "filename": filename,
+                    "line": orjson.dumps({"id": base_name, "html": html_content}) + b"\n"}
+
+        # 3. 将提取的HTML编码成 UTF-8 一次性写入新文件，不经过文本文件的编码层
+        write_file_bytes(output_path, html_content.encode("utf-8"))
 
         # 返回成功状态
         return {"status": "success", "filename": filename}
@@ -104,18 +236,47 @@ def process_single_file(filename: str, input_dir: str, output_dir: str) -> dict:
 
 # ========== 主进程逻辑 ==========
 
+def iter_warc_files(dir_path: str):
+    """
+    用 os.scandir 列出目录中的 .warc.gz 文件名（跳过 macOS 的 ._ 元数据文件）。
+    is_file() 直接使用读目录时得到的文件类型，不会对每个文件再 stat 一次。
+    """
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            name = entry.name
+            if name.endswith('.warc.gz') and not name.startswith('._') and entry.is_file():
+                yield name
+
 def get_processed_ids(dir_path: str) -> set:
     """
-    通过扫描输出目录中的 .html 文件来获取已处理文件的ID。
+    通过扫描输出目录中的 .html 文件和 html_*.jsonl 数据块来获取已处理文件的ID，
+    切换 OUTPUT_FORMAT 后也不会重复提取。
     """
     if not os.path.exists(dir_path):
         return set()
     
-    processed_ids = set()
-    for f in os.listdir(dir_path):
-        if f.endswith('.html'):
-            # 从 "xxxx.html" 中获取 "xxxx"
-            processed_ids.add(os.path.splitext(f)[0])
+    # 从 "xxxx.html" 中获取 "xxxx"
+    with os.scandir(dir_path) as it:
+        processed_ids = {os.path.splitext(e.name)[0] for e in it if e.name.endswith('.html')}
+
+    # 数据块的每一行都由 process_single_file 写出，以 {"id":"...", 开头，直接切出ID，
+    # ID 里有转义字符等格式不符的行才退回 orjson 解析
+    prefix = b'{"id":"'
+    for filepath in glob.glob(os.path.join(dir_path, "html_*.jsonl")):
+        try:
+            with open(filepath, "rb") as f:
+                for line in f:
+                    if line.startswith(prefix):
+                        end = line.find(b'"', len(prefix))
+                        record_id = line[len(prefix):end]
+                        if end != -1 and b"\\" not in record_id:
+                            processed_ids.add(record_id.decode("utf-8"))
+                            continue
+                    if line.strip():
+                        record = orjson.loads(line)
+                        if 'id' in record:
+                            processed_ids.add(record['id'])
+        except (orjson.JSONDecodeError, IOError): pass
     return processed_ids
 
 def main():
@@ -127,12 +288,12 @@ def main():
     if processed_ids:
         print(f"已找到 {len(processed_ids)} 个已提取的HTML文件，将跳过它们。")
 
-    all_warc_files = sorted([f for f in os.listdir(INPUT_DIR) if f.endswith('.warc.gz') and not f.startswith('._')])
+    all_warc_files = sorted(iter_warc_files(INPUT_DIR))
     
-    # 过滤掉已经处理过的文件
+    # 过滤掉已经处理过的文件：iter_warc_files 只返回 .warc.gz 文件，直接切掉后缀得到ID
     files_to_process = [
-        f for f in all_warc_files 
-        if os.path.splitext(os.path.splitext(f)[0])[0] not in processed_ids
+        f for f in all_warc_files
+        if f[:-len('.warc.gz')] not in processed_ids
     ]
             
     if not files_to_process:
@@ -144,22 +305,50 @@ def main():
 
     # 使用 multiprocessing.Pool 来并行处理文件
     with Pool(processes=NUM_PROCESSES) as pool, open(LOG_FILE, "a", encoding="utf-8") as log_f:
-        # 使用 functools.partial 预先填充 process_single_file 的 input_dir 和 output_dir 参数
-        worker_func = partial(process_single_file, input_dir=INPUT_DIR, output_dir=OUTPUT_HTML_DIR)
+        # 使用 functools.partial 预先填充 process_single_file 的 input_dir、output_dir 和 output_format 参数
+        worker_func = partial(process_single_file, input_dir=INPUT_DIR, output_dir=OUTPUT_HTML_DIR,
+                              output_format=OUTPUT_FORMAT)
         
         # 使用 imap_unordered 来获得最佳性能，它会按完成顺序返回结果
-        results_iterator = pool.imap_unordered(worker_func, files_to_process)
+        results_iterator = pool.imap_unordered(worker_func, files_to_process, chunksize=POOL_CHUNKSIZE)
         
         # 使用 tqdm 显示进度
         pbar = tqdm(results_iterator, total=len(files_to_process), desc="提取HTML")
         
-        for result in pbar:
-            if result and result.get("status") == "error":
-                # 记录失败的文件和原因
-                log_f.write(f"{result['filename']}\t{result['reason']}\n")
+        # --- jsonl 输出的分块写入逻辑 ---
+        output_file_handle = None
+        records_in_current_chunk = 0
+        chunk_index = len(glob.glob(os.path.join(OUTPUT_HTML_DIR, "html_*.jsonl"))) + 1
+
+        try:
+            for result in pbar:
+                if not result:
+                    continue
+                if result.get("status") == "error":
+                    # 记录失败的文件和原因
+                    log_f.write(f"{result['filename']}\t{result['reason']}\n")
+                elif "line" in result:
+                    # 检查是否需要开启新文件块
+                    if output_file_handle is None or records_in_current_chunk >= FILES_PER_CHUNK:
+                        if output_file_handle:
+                            output_file_handle.close()
+
+                        output_path = os.path.join(OUTPUT_HTML_DIR, f"html_{chunk_index:05d}.jsonl")
+                        output_file_handle = open(output_path, "ab", buffering=WRITE_BUFFER_SIZE)
+                        chunk_index += 1
+                        records_in_current_chunk = 0
+
+                    output_file_handle.write(result["line"])
+                    records_in_current_chunk += 1
+        finally:
+            if output_file_handle:
+                output_file_handle.close()
 
     print(f"\n✅ HTML提取完成！")
-    print(f"HTML文件已保存到目录: '{OUTPUT_HTML_DIR}'")
+    if OUTPUT_FORMAT == "jsonl":
+        print(f"HTML数据块已保存到目录: '{OUTPUT_HTML_DIR}'")
+    else:
+        print(f"HTML文件已保存到目录: '{OUTPUT_HTML_DIR}'")
     print(f"失败记录已写入: '{LOG_FILE}'")
 
 if __name__ == "__main__":
@@ -1,14 +1,41 @@
 import os
+import re
+import heapq
+import pickle
+import queue
+import shutil
+import zlib
 from tqdm import tqdm
-import json
+import orjson
 from urllib.parse import urlparse
+from multiprocessing import Pool, Process, Queue, cpu_count
 
 OUTPUT_DIR = "/Volumes/T7/cc/guardian_index"
 OUTPUT = "/Volumes/T7/cc/guardian_index/guardian_index_all.jsonl"
 TEMP_MERGED = "/Volumes/T7/cc/guardian_index/guardian_index_partial.jsonl"
 BATCH_SIZE = 100  # 一次处理多少个文件，可根据内存调整
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024  # 输出文件的写缓冲，逐条写入的记录攒满后才真正写一次
+# 并行解析批次文件的进程数，留一个核给主进程合并结果
+NUM_PROCESSES = max(1, cpu_count() - 1)
+# 去重表按 URL 哈希分成这么多个分片，每个分片由一个常驻进程独立维护，合并不再全压在主进程上
+SHARD_COUNT = NUM_PROCESSES
+# 各分片写出当前结果的临时目录，主进程再把分片文件归并成一个文件；全部完成后删除
+SHARD_DIR = "/Volumes/T7/cc/guardian_index/dedup_shards"
+# choose_better_record 比较时用到的字段
+QUALITY_FIELDS = ("status", "mime-detected", "length", "timestamp")
+
+# 常见的 "scheme://netloc/path?query#fragment" 形式用一个预编译正则处理，
+# 比每条记录构造一次 urlparse 的 ParseResult 快得多
+_URL_RE = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*://([^/?#\[\]\s]*)(?=[/?#]|$)([^?#;\s]*)(?=[?#]|$)')
 
 def normalize_url(url: str) -> str:
+    m = _URL_RE.match(url)
+    # 带 IPv6 方括号的域名、空白字符、路径里带 ";"（urlparse 会拆出 params）等少见情况交给下面的原始逻辑
+    if m:
+        netloc = m.group(1).lower()
+        if netloc.startswith("www."):
+            netloc = netloc[4:]
+        return netloc + m.group(2).rstrip("/")
     try:
         parsed = urlparse(url)
         netloc = parsed.netloc.lower()
@@ -39,34 +66,125 @@ def choose_better_record(old, new):
         return new
     return old
 
-def deduplicate_records(records, existing_map=None):
+def deduplicate_records(keyed_records, existing_map=None):
+    """
+    按顺序把 (规范化URL, 比较字段, 序列化后的行, 位置) 并入去重表，表中保存 (比较字段, 行, 位置)。
+    位置取该 URL 第一次出现时的序号，被更好的记录替换时不变，归并分片时据此恢复原来的输出顺序。
+    choose_better_record 不满足结合律（长度和时间戳是分开比较的），结果依赖合并顺序，
+    所以同一 URL 的记录必须按文件顺序逐条合并：同一 URL 总落在同一个分片，分片内按顺序处理。
+    """
     unique = existing_map or {}
-    for rec in tqdm(records, desc="去重中", leave=False):
-        url = rec.get("url")
-        if not url:
-            continue
-        key = normalize_url(url)
-        if key in unique:
-            unique[key] = choose_better_record(unique[key], rec)
-        else:
-            unique[key] = rec
+    for key, fields, line, pos in keyed_records:
+        old = unique.get(key)
+        if old is None:
+            unique[key] = (fields, line, pos)
+        elif choose_better_record(old[0], fields) is fields:
+            unique[key] = (fields, line, old[2])
     return unique
 
-def load_jsonl_file(file_path):
-    records = []
-    # with open(file_path, "r", encoding="utf-8") as f:
-    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+def shard_of(key: str) -> int:
+    # 内置 hash() 对 str 的结果每个进程都不同，这里要求所有子进程算出同一个分片号
+    return zlib.crc32(key.encode("utf-8")) % SHARD_COUNT
+
+def shard_path(shard: int) -> str:
+    return os.path.join(SHARD_DIR, f"shard_{shard:03d}.jsonl")
+
+def shard_worker(shard: int, inbox, outbox):
+    """
+    常驻的分片进程：从 inbox 依次取出主进程转发的记录块，并入本分片的去重表。
+    收到 "save" 时按首次出现的顺序把记录写到分片文件（每行前加位置），写完在 outbox 里回报记录数；
+    收到 None 时退出。
+    """
+    unique = {}
+    while True:
+        msg = inbox.get()
+        if msg is None:
+            return
+        if msg == "save":
+            with open(shard_path(shard), "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                for _, line, pos in unique.values():
+                    f.write(b"%d " % pos)
+                    f.write(line)
+            outbox.put(len(unique))
+        else:
+            unique = deduplicate_records(pickle.loads(msg), existing_map=unique)
+
+def iter_jsonl_records(file_path):
+    """逐行解析 JSONL 文件并逐条产出记录，不在内存中攒整个文件的记录列表。"""
+    # 按 bytes 读取直接交给 orjson 解析；含非法 UTF-8 字节的行才先按 errors="ignore" 解码再解析一次
+    with open(file_path, "rb") as f:
         for line in f:
             try:
-                records.append(json.loads(line))
-            except json.JSONDecodeError:
-                continue
-    return records
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                try:
+                    yield orjson.loads(line.decode("utf-8", errors="ignore"))
+                except orjson.JSONDecodeError:
+                    continue
 
-def save_jsonl(data_dict, output_path):
-    with open(output_path, "w", encoding="utf-8") as f:
-        for rec in data_dict.values():
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+def load_keyed_records(args):
+    """
+    在子进程中解析一个批次文件，返回 (记录条数, [分片 0 的记录块, 分片 1 的记录块, ...])。
+    每条记录转换成 (规范化URL, 比较字段, 序列化后的行, 位置)，按 URL 所在分片分组后各自 pickle 成 bytes，
+    主进程只需原样转发给对应的分片进程，不用拆包重组。
+    比较字段只含 choose_better_record 用到的键；整条记录在子进程里就序列化好，写文件时直接写出。
+    位置由文件序号和文件内序号拼成，按文件顺序、行顺序递增。没有 url 的记录直接跳过。
+    解析和转换在同一趟里完成，解析出的字典用完即释放。
+    """
+    file_index, file_path = args
+    shards = [[] for _ in range(SHARD_COUNT)]
+    count = 0
+    if os.path.getsize(file_path) > 0:
+        pos = file_index << 32
+        for rec in iter_jsonl_records(file_path):
+            count += 1
+            url = rec.get("url")
+            if url:
+                key = normalize_url(url)
+                # 只复制存在的键：缺失字段和原记录一样走 .get 的默认值
+                fields = {k: rec[k] for k in QUALITY_FIELDS if k in rec}
+                shards[shard_of(key)].append((key, fields, orjson.dumps(rec) + b"\n", pos))
+                pos += 1
+    return count, [pickle.dumps(records, pickle.HIGHEST_PROTOCOL) for records in shards]
+
+def send_to_shard(inbox, worker, msg):
+    """把消息放进分片进程的队列；队列满时等待，但分片进程已经退出时不再无限期等下去。"""
+    while True:
+        try:
+            inbox.put(msg, timeout=5)
+            return
+        except queue.Full:
+            if not worker.is_alive():
+                raise RuntimeError("分片进程异常退出")
+
+def iter_shard_lines(path):
+    """逐行读取分片文件，产出 (位置, 行)。"""
+    with open(path, "rb") as f:
+        for row in f:
+            pos, line = row.split(b" ", 1)
+            yield int(pos), line
+
+def save_shards(inboxes, outbox, workers, output_path):
+    """
+    让各分片进程写出当前结果，再按位置把分片文件归并到 output_path。
+    每个 URL 排在它第一次出现的位置，输出顺序和只用一个去重表时相同。返回唯一记录数。
+    """
+    for inbox, worker in zip(inboxes, workers):
+        send_to_shard(inbox, worker, "save")
+    total = 0
+    for _ in workers:
+        while True:
+            try:
+                total += outbox.get(timeout=5)
+                break
+            except queue.Empty:
+                # 分片进程异常退出后不会再回报，不能一直等下去
+                if not all(w.is_alive() for w in workers):
+                    raise RuntimeError("分片进程异常退出")
+    with open(output_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        for _, line in heapq.merge(*(iter_shard_lines(shard_path(i)) for i in range(len(workers)))):
+            f.write(line)
+    return total
 
 def main_merge_and_deduplicate():
     print("\n===== 阶段 3: 分批合并与去重 =====")
@@ -80,30 +198,46 @@ def main_merge_and_deduplicate():
         print(f"在输出目录 '{OUTPUT_DIR}' 中没有找到任何 .jsonl 文件。")
         return
 
-    global_unique = {}
-
-    # 分批处理
-    for i in range(0, len(batch_files), BATCH_SIZE):
-        subset = batch_files[i:i + BATCH_SIZE]
-        print(f"\n📦 处理第 {i // BATCH_SIZE + 1} 批，共 {len(subset)} 个文件")
-        all_records = []
-        for fname in tqdm(subset, desc="加载文件"):
-            file_path = os.path.join(OUTPUT_DIR, fname)
-            if os.path.getsize(file_path) == 0:
-                continue
-            all_records.extend(load_jsonl_file(file_path))
-
-        print(f"→ 当前批次加载 {len(all_records)} 条记录，正在去重...")
-        global_unique = deduplicate_records(all_records, existing_map=global_unique)
-        print(f"→ 当前累计唯一记录数：{len(global_unique)}")
-
-        # 中间保存一次，防止中途崩溃丢数据
-        save_jsonl(global_unique, TEMP_MERGED)
-        print(f"💾 已保存中间结果至 {TEMP_MERGED}")
-
-    print("\n✅ 全部分批处理完毕，最终保存结果...")
-    save_jsonl(global_unique, OUTPUT)
-    print(f"✅ 已合并并保存到 {OUTPUT}")
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    # 队列设上限：分片进程处理不过来时主进程停下等待，记录块不会在内存里越堆越多
+    inboxes = [Queue(maxsize=64) for _ in range(SHARD_COUNT)]
+    outbox = Queue()
+    workers = [Process(target=shard_worker, args=(i, inboxes[i], outbox), daemon=True) for i in range(SHARD_COUNT)]
+    for w in workers:
+        w.start()
+
+    try:
+        # 解析 JSON 和规范化 URL 各文件相互独立，交给进程池并行；imap 按文件顺序返回，
+        # 主进程依次把记录块转发给各分片进程，同一 URL 的记录仍按文件顺序合并
+        with Pool(processes=NUM_PROCESSES) as pool:
+            # 分批处理
+            for i in range(0, len(batch_files), BATCH_SIZE):
+                subset = batch_files[i:i + BATCH_SIZE]
+                print(f"\n📦 处理第 {i // BATCH_SIZE + 1} 批，共 {len(subset)} 个文件")
+                tasks = [(i + j, os.path.join(OUTPUT_DIR, fname)) for j, fname in enumerate(subset)]
+                batch_records = 0
+                results_iterator = pool.imap(load_keyed_records, tasks, chunksize=4)
+                for count, shard_chunks in tqdm(results_iterator, total=len(tasks), desc="加载并去重文件"):
+                    batch_records += count
+                    for inbox, worker, chunk in zip(inboxes, workers, shard_chunks):
+                        send_to_shard(inbox, worker, chunk)
+
+                # 中间保存一次，防止中途崩溃丢数据
+                unique_count = save_shards(inboxes, outbox, workers, TEMP_MERGED)
+                print(f"→ 当前批次加载 {batch_records} 条记录，已完成去重")
+                print(f"→ 当前累计唯一记录数：{unique_count}")
+                print(f"💾 已保存中间结果至 {TEMP_MERGED}")
+
+        print("\n✅ 全部分批处理完毕，最终保存结果...")
+        save_shards(inboxes, outbox, workers, OUTPUT)
+        print(f"✅ 已合并并保存到 {OUTPUT}")
+    finally:
+        for inbox, worker in zip(inboxes, workers):
+            if worker.is_alive():
+                inbox.put(None)
+        for w in workers:
+            w.join()
+        shutil.rmtree(SHARD_DIR, ignore_errors=True)
     print("下一步：可使用正文下载脚本提取网页内容。")
 
 if __name__ == "__main__":
@@ -1,26 +1,61 @@
 # package_batches.py
 import os
+import gzip
 import tarfile
 import shutil
-import tarfile  # 确保 tarfile 被导入，以便在类型提示中使用
-from typing import Optional # 用于类型提示
+import subprocess
 from tqdm import tqdm
+# 安装了 isal 时用 ISA-L 的 SIMD 实现解压 .tar.gz 做校验，接口与 gzip 模块一致
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+# 打包格式选 zst 时需要 zstandard
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
 
 # ========== 配置 (应与下载脚本保持一致) ==========
 # 存放所有批次文件夹的根目录
 OUTPUT_DIR = "/Volumes/T7/cc/guardian_warc_segments"
+# 打包格式。段文件本身已经是 .warc.gz，外面再套一层 gzip 几乎不省空间，只白白消耗 CPU：
+#   "tar"：只打包不压缩（默认）；"zst"：zstd 多线程压缩（需要 zstandard）；"gz"：原来的 .tar.gz
+ARCHIVE_FORMAT = "tar"
+ARCHIVE_SUFFIXES = {"tar": ".tar", "zst": ".tar.zst", "gz": ".tar.gz"}
+ZSTD_LEVEL = 3
+# 打包为 .tar.gz 且系统装有 pigz 时用它多线程压缩，否则退回 tarfile 内置的单线程 gzip
+PIGZ = shutil.which("pigz")
+PIGZ_THREADS = os.cpu_count() or 1
 
 def verify_tarball(archive_path: str) -> bool:
     """
-    校验tar.gz压缩包的完整性。
+    校验压缩包的完整性。
     它会尝试读取压缩包中的所有文件头信息。
     如果成功完成且没有异常，则认为压缩包是完整的。
     """
     print(f"正在校验 '{os.path.basename(archive_path)}'...")
     try:
-        with tarfile.open(archive_path, "r:gz") as tar:
-            for member in tqdm(tar.getmembers(), desc="校验中", unit=" files"):
-                pass
+        if archive_path.endswith(".zst"):
+            # zstd 流不能随机访问，按流式模式从头读到尾
+            with zstd.ZstdDecompressor().stream_reader(open(archive_path, "rb"), closefd=True) as raw, \
+                 tarfile.open(fileobj=raw, mode="r|") as tar:
+                for member in tqdm(tar, desc="校验中", unit=" files"):
+                    pass
+        elif archive_path.endswith(".gz"):
+            # 流式模式顺序解压一遍即可，不走 r:gz 随机访问模式里 GzipFile 的 seek；
+            # 读完成员后再读到文件末尾，让 gzip 校验 CRC 和长度
+            gzip_open = igzip.open if igzip is not None else gzip.open
+            with gzip_open(archive_path, "rb") as gz, tarfile.open(fileobj=gz, mode="r|") as tar:
+                for member in tqdm(tar, desc="校验中", unit=" files"):
+                    pass
+                while gz.read(1024 * 1024):
+                    pass
+        else:
+            # 不压缩的 tar 可以随机访问，读文件头时直接 seek 跳过文件内容
+            with tarfile.open(archive_path, "r:") as tar:
+                for member in tqdm(tar.getmembers(), desc="校验中", unit=" files"):
+                    pass
         print(f"✅ 校验成功: '{archive_path}' 结构完整。")
         return True
     except tarfile.ReadError as e:
@@ -30,40 +65,82 @@ def verify_tarball(archive_path: str) -> bool:
         print(f"❌ 校验时发生未知错误: {e}")
         return False
 
-# ================== 新增的过滤器函数 ==================
-def exclude_filter(tarinfo: tarfile.TarInfo) -> Optional[tarfile.TarInfo]:
+def add_batch_dir(tar: tarfile.TarFile, dir_path: str, arcname: str = "."):
     """
-    用于 tarfile.add() 的过滤器。
-    如果文件名以 '._' 开头，则排除该文件。
-    这些是 macOS 在 ExFAT/FAT32 驱动器上创建的元数据文件。
+    代替 tar.add(dir_path, arcname='.', filter=...)，把目录内容写入 tar。
+    用 os.scandir 遍历，以 '._' 开头的文件（macOS 在 ExFAT/FAT32 驱动器上创建的元数据文件）
+    只看文件名就跳过，不再先 stat 一次再交给过滤器排除。
+    成员名称（'.'、'./xxx'）和顺序（按文件名排序）与 tar.add 生成的一致。
     """
-    file_name = os.path.basename(tarinfo.name)
-    if file_name.startswith("._"):
-        # 返回 None 会告诉 tarfile 跳过这个文件
-        return None
-    else:
-        # 返回 tarinfo 对象以正常包含该文件
-        return tarinfo
-# ======================================================
+    tar.addfile(tar.gettarinfo(dir_path, arcname))
+    with os.scandir(dir_path) as it:
+        entries = sorted((e for e in it if not e.name.startswith("._")), key=lambda e: e.name)
+    for entry in entries:
+        member_name = os.path.join(arcname, entry.name)
+        # 批次目录通常是平的；万一有子目录，和 tar.add 一样递归进去
+        if entry.is_dir(follow_symlinks=False):
+            add_batch_dir(tar, entry.path, member_name)
+            continue
+        tarinfo = tar.gettarinfo(entry.path, member_name)
+        if tarinfo is None:
+            continue  # 套接字等 tar 不支持的类型，tar.add 同样跳过
+        if tarinfo.isreg():
+            with open(entry.path, "rb") as f:
+                tar.addfile(tarinfo, f)
+        else:
+            tar.addfile(tarinfo)
+
+def write_tarball_pigz(source_dir: str, archive_path: str):
+    """tarfile 只负责生成未压缩的 tar 流（过滤规则不变），通过管道交给 pigz 多线程压缩。"""
+    with open(archive_path, "wb") as out:
+        proc = subprocess.Popen([PIGZ, "-p", str(PIGZ_THREADS), "-c"], stdin=subprocess.PIPE, stdout=out)
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|", bufsize=1024 * 1024) as tar:
+                add_batch_dir(tar, source_dir)
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass  # pigz 已提前退出，下面按返回码报错
+            returncode = proc.wait()
+    if returncode != 0:
+        raise RuntimeError(f"pigz 异常退出，返回码 {returncode}")
+
+def write_tarball_zstd(source_dir: str, archive_path: str):
+    """tar 流交给 zstd 压缩，threads=-1 使用所有 CPU 核心。"""
+    with open(archive_path, "wb") as raw, \
+         zstd.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).stream_writer(raw, closefd=False) as z, \
+         tarfile.open(fileobj=z, mode="w|", bufsize=1024 * 1024) as tar:
+        add_batch_dir(tar, source_dir)
 
 def create_tarball(source_dir: str):
-    """将指定的源目录打包成tar.gz文件，然后校验其完整性，并排除 ._ 文件。"""
+    """将指定的源目录按 ARCHIVE_FORMAT 打包，然后校验其完整性，并排除 ._ 文件。"""
     dir_name = os.path.basename(source_dir)
-    archive_name = f"{dir_name}.tar.gz"
+    archive_format = ARCHIVE_FORMAT
+    if archive_format == "zst" and zstd is None:
+        print("⚠️ 未安装 zstandard，改为打包成不压缩的 .tar。")
+        archive_format = "tar"
+    archive_name = f"{dir_name}{ARCHIVE_SUFFIXES[archive_format]}"
     archive_path = os.path.join(os.path.dirname(source_dir), archive_name)
 
-    if os.path.exists(archive_path):
-        print(f"\n⚠️ 跳过 '{dir_name}'，因为压缩包 '{archive_name}' 已存在。")
-        return
+    # 以任何格式打包过的目录都跳过，切换格式后不会把旧批次重新打包一遍
+    for suffix in ARCHIVE_SUFFIXES.values():
+        existing_name = f"{dir_name}{suffix}"
+        if os.path.exists(os.path.join(os.path.dirname(source_dir), existing_name)):
+            print(f"\n⚠️ 跳过 '{dir_name}'，因为压缩包 '{existing_name}' 已存在。")
+            return
 
     print(f"\n正在打包 '{source_dir}' -> '{archive_path}'...")
     
     try:
         print(f"正在添加 '{dir_name}' 的内容到压缩包 (将排除 '._' 文件)...")
-        with tarfile.open(archive_path, "w:gz") as tar:
-            # ============ 在这里使用 filter 参数 ============
-            tar.add(source_dir, arcname='.', filter=exclude_filter)
-            # =============================================
+        if archive_format == "zst":
+            write_tarball_zstd(source_dir, archive_path)
+        elif archive_format == "gz" and PIGZ:
+            write_tarball_pigz(source_dir, archive_path)
+        else:
+            with tarfile.open(archive_path, "w:gz" if archive_format == "gz" else "w") as tar:
+                add_batch_dir(tar, source_dir)
 
         print(f"✅ 打包成功: '{archive_path}'")
         
@@ -87,7 +164,8 @@ def main():
         return
 
     try:
-        all_dirs = [d for d in os.listdir(OUTPUT_DIR) if os.path.isdir(os.path.join(OUTPUT_DIR, d)) and d.startswith("batch_")]
+        with os.scandir(OUTPUT_DIR) as it:
+            all_dirs = [e.name for e in it if e.name.startswith("batch_") and e.is_dir(follow_symlinks=False)]
     except FileNotFoundError:
         all_dirs = []
 
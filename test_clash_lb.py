@@ -81,7 +81,12 @@ def main():
 
     # 使用 requests.Session 以利用连接池管理，但每次请求都会被强制关闭
     session = requests.Session()
-    
+    # 默认每个主机的连接池只有 10 个连接，并发线程更多时多出的连接用完即丢；
+    # 按线程数放大连接池，每个 IP 检测 API 各占一个池
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(IP_CHECK_APIS), pool_maxsize=args.workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
     # 首次测试：检查代理是否可用
     print("正在测试代理连通性...")
     initial_ip = get_public_ip(session, proxies)